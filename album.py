@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import fcntl
+import queue
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+import settings
+import metrics
+import power
+
+# Linux ioctl to share the file extents on CoW filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+# Hash read block, keeps the memory usage flat for the big videos
+CHUNK_SIZE = 1024 * 1024
+# Save the index after so many new hashes
+SAVE_EVERY = 50
+
+_lock = threading.Lock()
+_by_hash = {}   # hash -> set of paths
+_by_path = {}   # path -> (size, mtime_ns, hash)
+_queue = queue.Queue()
+_worker_thread = None
+_dirty = 0
+
+def _config() -> dict:
+    return settings.get("album", {})
+
+def _index_path() -> str:
+    return _config().get("index", "album_index.json")
+
+def file_hash(path: str) -> str:
+    """Streams the file content through sha256"""
+    h = hashlib.sha256()
+    with open(path, "rb") as fd:
+        while True:
+            chunk = fd.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def known_hash(path: str) -> (str, None):
+    """Indexed content hash of the path if the file is not changed since"""
+    entry = _by_path.get(path)
+    if entry is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if stat.st_size != entry[0] or stat.st_mtime_ns != entry[1]:
+        return None
+    return entry[2]
+
+def _add(path: str, size: int, mtime: int, digest: str) -> None:
+    with _lock:
+        old = _by_path.get(path)
+        if old is not None and old[2] != digest:
+            _by_hash.get(old[2], set()).discard(path)
+        _by_path[path] = (size, mtime, digest)
+        _by_hash.setdefault(digest, set()).add(path)
+
+def forget(path: str) -> None:
+    """Removes the path from the index"""
+    global _dirty
+    with _lock:
+        old = _by_path.pop(path, None)
+        if old is None:
+            return
+        paths = _by_hash.get(old[2])
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del _by_hash[old[2]]
+        _dirty += 1
+
+def queue_hash(path: str) -> None:
+    """Schedules the path hashing in background"""
+    _queue.put(path)
+
+def _process(path: str) -> None:
+    global _dirty
+    try:
+        stat = os.stat(path)
+    except OSError:
+        forget(path)
+        return
+    cached = _by_path.get(path)
+    if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return
+    with metrics.timed("album_hash_seconds"):
+        digest = file_hash(path)
+    metrics.counter("album_hashed_bytes_total").inc(stat.st_size)
+    _add(path, stat.st_size, stat.st_mtime_ns, digest)
+    _dirty += 1
+
+def _background_hashing() -> None:
+    """Works in a loop to hash the queued files"""
+    global _dirty
+    try:
+        # Idle priority for this thread only, do not interfere with display
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+    while True:
+        path = _queue.get()
+        power.wait_awake()
+        try:
+            _process(path)
+        except OSError as e:
+            logger.warning("Unable to hash %s: %s", path, e)
+        if _dirty >= SAVE_EVERY or (_dirty and _queue.empty()):
+            save()
+
+def load() -> None:
+    """Loads the persisted hash index"""
+    try:
+        with open(_index_path(), "r") as fd:
+            data = json.load(fd)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.warning("Unable to load album index: %s", e)
+        return
+    for path, (size, mtime, digest) in data.items():
+        _add(path, size, mtime, digest)
+    logger.info("Loaded album index: %d files, %d unique", len(_by_path), len(_by_hash))
+
+def save() -> None:
+    """Atomically writes the hash index"""
+    global _dirty
+    with _lock:
+        data = json.dumps(_by_path)
+        _dirty = 0
+    path = _index_path()
+    with open(path + ".tmp", "w") as fd:
+        fd.write(data)
+    os.replace(path + ".tmp", path)
+
+def init() -> None:
+    """Loads the index and starts the background hashing"""
+    global _worker_thread
+    if _worker_thread is not None:
+        return
+    load()
+    _worker_thread = threading.Thread(target=_background_hashing, name="album")
+    _worker_thread.daemon = True
+    _worker_thread.start()
+
+def prune(paths: set) -> None:
+    """Forgets the indexed paths which are not in the album anymore"""
+    for path in [p for p in list(_by_path) if p not in paths]:
+        forget(path)
+
+def is_duplicate(path: str) -> bool:
+    """True if the path content is known under the other canonical path"""
+    entry = _by_path.get(path)
+    if entry is None:
+        return False
+    with _lock:
+        paths = _by_hash.get(entry[2])
+        return bool(paths) and min(paths) != path
+
+def duplicates() -> dict:
+    """Returns hash -> paths for the content stored more than once"""
+    with _lock:
+        return {h: sorted(p) for h, p in _by_hash.items() if len(p) > 1}
+
+def store_directory() -> (str, None):
+    """Directory to save the received media, None if saving is disabled"""
+    return _config().get("store_directory")
+
+def tempfile_for(suffix: str):
+    """Temp file on the same filesystem as the store to link it without copy"""
+    directory = store_directory()
+    if not directory:
+        return tempfile.NamedTemporaryFile(suffix=suffix)
+    os.makedirs(directory, exist_ok=True)
+    # Not supported extension, so the slideshow watcher will skip it
+    return tempfile.NamedTemporaryFile(prefix=".", suffix=".part", dir=directory)
+
+def link_file(src: str, dst: str) -> None:
+    """Hardlinks or reflinks the file, copies only as the last resort"""
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    with open(src, "rb") as sfd, open(dst, "wb") as dfd:
+        try:
+            fcntl.ioctl(dfd.fileno(), FICLONE, sfd.fileno())
+            return
+        except OSError:
+            logger.warning("Unable to link %s, copying the content", src)
+            shutil.copyfileobj(sfd, dfd, CHUNK_SIZE)
+
+def store(path: str, ext: str) -> (str, None):
+    """Saves the received media file to the album under its content hash
+
+    Returns the album path or None if saving is disabled. If the same
+    content is already in the album the existing path is returned.
+    """
+    global _dirty
+    directory = store_directory()
+    if not directory:
+        return None
+
+    digest = file_hash(path)
+    with _lock:
+        known = sorted(_by_hash.get(digest, ()))
+    if known:
+        logger.info("Media %s is already in the album as %s", path, known[0])
+        return known[0]
+
+    dst = os.path.join(directory, digest + "." + ext)
+    if not os.path.exists(dst):
+        link_file(path, dst)
+    stat = os.stat(dst)
+    _add(dst, stat.st_size, stat.st_mtime_ns, digest)
+    _dirty += 1
+    logger.info("Stored media in album: %s", dst)
+    return dst
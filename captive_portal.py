@@ -5,6 +5,7 @@ import logging
 import socket
 import subprocess
 import time
+import selectors
 import tempfile
 
 logger = logging.getLogger(__name__)
@@ -23,8 +24,8 @@ def checkTCPConnection(address: str, port: int, retry:int = 3) -> bool:
 
     return False
 
-def _exec(cmd: list) -> subprocess.Popen:
-    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def _exec(cmd: list, **kwargs) -> subprocess.Popen:
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
 
 def _exec_wait(cmd: list) -> (str, bool):
     ret = _exec(cmd)
@@ -45,10 +46,206 @@ def wpaNetworksChange(action: bool = True) -> None:
             if _exec_wait(['wpa_cli', '-i', 'wlan0', ('enable_network' if action else 'disable_network'), data[0]]) == False:
                 raise Exception('Unable to %s network %s' % (data, ('enable' if action else 'disable')))
 
+
+class Daemon:
+    """Supervised process with its pipes and restart state"""
+
+    def __init__(self, name: str, cmd: list, restart: bool = True):
+        self.name = name
+        self.cmd = cmd
+        self.restart = restart
+        self.proc = None
+        self.pidfd = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.next_start = 0.0
+        self.returncode = None
+        self._partial = {}
+
+    def running(self) -> bool:
+        return self.proc is not None
+
+class Supervisor:
+    """Runs the daemons and reacts on their output and exits without polling
+
+    Pipes and process pidfds are registered in the selector, so the loop is
+    sleeping until some daemon writes a log line or exits. The exited daemon
+    is restarted with exponential backoff unless `on_exit` tells to stop.
+    """
+
+    BACKOFF_MIN = 1.0
+    BACKOFF_MAX = 60.0
+    # Daemon working longer than that is considered stable and resets backoff
+    STABLE_TIME = 60.0
+    # Used only if pidfd is not available on the system
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, on_exit = None):
+        self._selector = selectors.DefaultSelector()
+        self._daemons = []
+        self._on_exit = on_exit
+        self._stopped = False
+
+    def add(self, name: str, cmd: list, restart: bool = True) -> Daemon:
+        daemon = Daemon(name, cmd, restart)
+        self._daemons.append(daemon)
+        return daemon
+
+    def daemons(self) -> list:
+        return self._daemons
+
+    def stop(self) -> None:
+        """Makes the run loop to exit on the next iteration"""
+        self._stopped = True
+
+    def _start(self, daemon: Daemon) -> None:
+        logger.info('Starting %s', daemon.name)
+        # Own process group to kill the daemon with its children, SIGKILL to
+        # the sudo wrapper alone would leave the actual daemon running
+        daemon.proc = _exec(daemon.cmd, start_new_session=True)
+        daemon.started_at = time.monotonic()
+        daemon.returncode = None
+        for stream, level in ((daemon.proc.stdout, logging.INFO), (daemon.proc.stderr, logging.WARNING)):
+            os.set_blocking(stream.fileno(), False)
+            daemon._partial[stream.fileno()] = b''
+            self._selector.register(stream, selectors.EVENT_READ, (daemon, level))
+        try:
+            daemon.pidfd = os.pidfd_open(daemon.proc.pid)
+            self._selector.register(daemon.pidfd, selectors.EVENT_READ, (daemon, None))
+        except (AttributeError, OSError):
+            daemon.pidfd = None
+
+    def _log_output(self, daemon: Daemon, fileobj, level: int) -> (bool, None):
+        """Streams the available daemon output line by line, returns False on EOF and None if no data"""
+        fd = fileobj.fileno()
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return None
+        lines = (daemon._partial[fd] + data).split(b'\n')
+        daemon._partial[fd] = lines.pop() if data else b''
+        for line in lines:
+            if line:
+                logger.log(level, '%s: %s', daemon.name, line.decode(errors='replace').rstrip())
+        return bool(data)
+
+    def _release(self, daemon: Daemon) -> None:
+        """Drains and unregisters the exited daemon pipes"""
+        for stream, level in ((daemon.proc.stdout, logging.INFO), (daemon.proc.stderr, logging.WARNING)):
+            if stream.closed:
+                continue
+            try:
+                while self._log_output(daemon, stream, level):
+                    pass
+            except OSError:
+                pass
+            self._selector.unregister(stream)
+            stream.close()
+        if daemon.pidfd is not None:
+            self._selector.unregister(daemon.pidfd)
+            os.close(daemon.pidfd)
+            daemon.pidfd = None
+        daemon.proc = None
+
+    def _exited(self, daemon: Daemon) -> None:
+        daemon.returncode = daemon.proc.wait()
+        uptime = time.monotonic() - daemon.started_at
+        self._release(daemon)
+        logger.log(logging.INFO if daemon.returncode == 0 else logging.ERROR,
+            '%s exited with code %d after %.1fs', daemon.name, daemon.returncode, uptime)
+
+        if self._on_exit is not None and self._on_exit(daemon) is False:
+            self.stop()
+            return
+        if not daemon.restart:
+            return
+
+        if uptime > self.STABLE_TIME:
+            daemon.restarts = 0
+        delay = min(self.BACKOFF_MIN * 2 ** daemon.restarts, self.BACKOFF_MAX)
+        daemon.restarts += 1
+        daemon.next_start = time.monotonic() + delay
+        logger.warning('Restarting %s in %.1fs', daemon.name, delay)
+
+    def run(self) -> None:
+        """Starts the daemons and supervises them until stopped or all are gone"""
+        for daemon in self._daemons:
+            self._start(daemon)
+
+        while not self._stopped:
+            now = time.monotonic()
+            pending = [d for d in self._daemons if not d.running() and d.restart and d.returncode is not None]
+            for daemon in pending:
+                if daemon.next_start <= now:
+                    self._start(daemon)
+
+            waiting = [d.next_start - now for d in pending if not d.running()]
+            if not waiting and not any(d.running() for d in self._daemons):
+                raise Exception('All the apps stopped')
+
+            timeout = min(waiting) if waiting else None
+            if any(d.running() and d.pidfd is None for d in self._daemons):
+                timeout = min(timeout or self.POLL_INTERVAL, self.POLL_INTERVAL)
+
+            for key, _ in self._selector.select(timeout):
+                daemon, level = key.data
+                if not daemon.running():
+                    continue
+                if level is None:
+                    self._exited(daemon)
+                elif self._log_output(daemon, key.fileobj, level) is False:
+                    self._selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                if self._stopped:
+                    break
+
+            for daemon in self._daemons:
+                if not self._stopped and daemon.running() and daemon.pidfd is None and daemon.proc.poll() is not None:
+                    self._exited(daemon)
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        """Terminates all the running daemons"""
+        for daemon in self._daemons:
+            if not daemon.running():
+                continue
+            logger.info('Stopping %s', daemon.name)
+            daemon.proc.terminate()
+        for daemon in self._daemons:
+            if not daemon.running():
+                continue
+            try:
+                daemon.proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                logger.warning('%s is not responding, killing it', daemon.name)
+                _exec_wait(['sudo', 'kill', '-9', '--', '-%d' % daemon.proc.pid])
+                daemon.proc.wait()
+            self._release(daemon)
+        self._selector.close()
+
+def teardownAccessPoint() -> None:
+    """Returns the wlan0 interface back to the client mode"""
+    _exec_wait(['sudo', 'systemctl', 'start', 'dnsmasq'])
+
+    if _exec_wait(['sudo', 'ip', 'link', 'set', 'dev', 'wlan0', 'down']) == False:
+        raise Exception('Unable to shutdown the wlan0 interface')
+
+    wpaNetworksChange(True)
+
+    if _exec_wait(['sudo', 'ip', 'link', 'set', 'dev', 'wlan0', 'up']) == False:
+        raise Exception('Unable to startup the wlan0 interface')
+
 def runCaptivePortal() -> None:
-    dnsmasq = None
-    hostapd = None
-    captive = None
+    supervisor = None
+    saved = False
+
+    def on_exit(daemon: Daemon) -> bool:
+        nonlocal saved
+        # The webapp exits with 0 only when the WiFi credentials are saved
+        if daemon.name == 'captive_portal' and daemon.returncode == 0:
+            logger.info('WiFi credentials saved, stopping the access point')
+            saved = True
+            return False
+        return True
 
     try:
         wpaNetworksChange(False)
@@ -65,11 +262,13 @@ def runCaptivePortal() -> None:
         # Stop dnsmasq service
         _exec_wait(['sudo', 'systemctl', 'stop', 'dnsmasq'])
 
+        supervisor = Supervisor(on_exit)
+
         # Run dsmasq
-        dnsmasq = _exec(['sudo', 'dnsmasq', '--no-daemon', '--interface', 'wlan0', '--listen-address', '192.168.0.1', '--no-hosts', '--bind-interfaces', '--domain-needed', '--bogus-priv', '--dhcp-leasefile=/run/dnsmasq/dnsmasq.leases', '--dhcp-range', '192.168.0.50,192.168.0.150,12h', '--dhcp-option', '114,http://setup.teleglobe/', '--dhcp-option', 'option:router,192.168.0.1', '--dhcp-authoritative', '--address', '/#/192.168.0.1'])
+        supervisor.add('dnsmasq', ['sudo', 'dnsmasq', '--no-daemon', '--interface', 'wlan0', '--listen-address', '192.168.0.1', '--no-hosts', '--bind-interfaces', '--domain-needed', '--bogus-priv', '--dhcp-leasefile=/run/dnsmasq/dnsmasq.leases', '--dhcp-range', '192.168.0.50,192.168.0.150,12h', '--dhcp-option', '114,http://setup.teleglobe/', '--dhcp-option', 'option:router,192.168.0.1', '--dhcp-authoritative', '--address', '/#/192.168.0.1'])
 
         # Run simple http server
-        captive = _exec(['sudo', sys.executable, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'captive_portal_webapp.py')])
+        supervisor.add('captive_portal', ['sudo', sys.executable, '-u', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'captive_portal_webapp.py')])
 
         # Create hostapd config
         tf = tempfile.NamedTemporaryFile(suffix="hostapd.conf")
@@ -95,48 +294,25 @@ def runCaptivePortal() -> None:
         tf.flush()
 
         # Run hostapd
-        hostapd = _exec(['sudo', 'hostapd', tf.name])
-
-        while True:
-            if hostapd.poll() != None:
-                logger.error('hostapd exited: STDOUT:%s \n\nSTDERR:%s', *hostapd.communicate())
-                hostapd = None
-            if dnsmasq.poll() != None:
-                logger.error('dnsmasq exited: STDOUT:%s \n\nSTDERR:%s', dnsmasq.communicate())
-                dnsmasq = None
-            if captive.poll() != None:
-                logger.error('captive_portal exited: STDOUT:%s \n\nSTDERR:%s', captive.communicate())
-                captive = None
-            if hostapd == None and dnsmasq == None and captive == None:
-                raise Exception('All the apps stopped')
-            time.sleep(1)
+        supervisor.add('hostapd', ['sudo', 'hostapd', tf.name])
+
+        supervisor.run()
     except (Exception, KeyboardInterrupt) as e:
         logger.error('ERROR: %s', e)
     finally:
-        #if captive and captive.poll() == None:
-        #    print(_exec(['sudo', 'kill', '-9', str(captive.pid)]).communicate())
-        #    print('captive interrupted: STDOUT:%s \n\nSTDERR:%s' % captive.communicate())
-
-        #if hostapd and hostapd.poll() == None:
-        #    print(_exec(['sudo', 'kill', '-9', str(hostapd.pid)]).communicate())
-        #    print('hostapd interrupted: STDOUT:%s \n\nSTDERR:%s' % hostapd.communicate())
-
-        #if dnsmasq and dnsmasq.poll() == None:
-        #    print(_exec(['sudo', 'kill', '-9', str(dnsmasq.pid)]).communicate())
-        #    print('dnsmasq interrupted: STDOUT:%s \n\nSTDERR:%s' % dnsmasq.communicate())
-
-        #_exec_wait(['sudo', 'systemctl', 'start', 'dnsmasq'])
+        if supervisor is not None:
+            supervisor.shutdown()
 
-        #if _exec_wait(['sudo', 'ip', 'link', 'set', 'dev', 'wlan0', 'down']) == False:
-        #    raise Exception('Unable to shutdown the wlan0 interface')
-
-        #wpaNetworksChange(True)
-
-        #if _exec_wait(['sudo', 'ip', 'link', 'set', 'dev', 'wlan0', 'up']) == False:
-        #    raise Exception('Unable to startup the wlan0 interface')
-
-        logger.warning("REBOOT in 30s")
-        time.sleep(30)
-        logger.warning("REBOOT NOW")
-        # _exec_wait(["sudo", "reboot"])
+        try:
+            teardownAccessPoint()
+        except Exception as e:
+            logger.error('Unable to teardown the access point: %s', e)
 
+        if saved:
+            logger.warning("REBOOT NOW")
+            _exec_wait(["sudo", "reboot"])
+        else:
+            logger.warning("REBOOT in 30s")
+            time.sleep(30)
+            logger.warning("REBOOT NOW")
+            # _exec_wait(["sudo", "reboot"])
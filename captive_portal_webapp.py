@@ -2,11 +2,25 @@
 
 import subprocess
 import html
+import socket
+import threading
+import time
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from cgi import parse_header
 from urllib.parse import parse_qs
 
+# How often the background thread refreshes the WiFi networks list
+NETWORKS_REFRESH_TTL = 15
+# Max size of the POST form body
+MAX_BODY_SIZE = 10240
+# Time limit for the client request read (line, headers and body)
+READ_TIMEOUT = 10
+# Max requests handled at once, the rest wait in the listen backlog
+MAX_HANDLERS = 32
+
+SETUP_HOST = "setup.teleglobe"
+
 def _exec(cmd: list) -> subprocess.Popen:
     return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
@@ -49,44 +63,176 @@ index = """<html><head><title>TeleGlobe setup</title></head>
 </body></html>
 """
 
+def _raw_response(status: str, headers: list, body: bytes = b"") -> bytes:
+    """Prebuilds the complete HTTP response to send it with a single write"""
+    lines = ["HTTP/1.0 " + status] + headers + [
+        "Content-Length: %d" % len(body),
+        "Connection: close",
+    ]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+_redirect_response = _raw_response("302 Found", ["Location: http://%s/" % SETUP_HOST])
+
+# OS connectivity probes - answered without touching the template or wpa_cli.
+# Any non-expected answer makes the OS to show the captive portal login page.
+_probe_responses = {
+    # Android / ChromeOS expect 204
+    "/generate_204": _redirect_response,
+    "/gen_204": _redirect_response,
+    # Apple expects "Success" page
+    "/hotspot-detect.html": _raw_response("200 OK", ["Content-Type: text/html"],
+        b"<html><head><title>TeleGlobe</title><meta http-equiv=\"refresh\" content=\"0;url=http://%s/\"></head></html>" % SETUP_HOST.encode()),
+    "/library/test/success.html": _redirect_response,
+    # Windows expects "Microsoft Connect Test"
+    "/connecttest.txt": _redirect_response,
+    "/ncsi.txt": _redirect_response,
+    "/redirect": _redirect_response,
+    # Firefox expects "success"
+    "/success.txt": _redirect_response,
+    "/canonical.html": _redirect_response,
+}
+
+_networks = []
+_networks_lock = threading.Lock()
+_rendered = {}
+
+def _refresh_networks() -> None:
+    """Updates the available networks list and drops the rendered pages cache"""
+    global _networks
+    networks = wpaNetworksList()
+    with _networks_lock:
+        if networks != _networks:
+            _networks = networks
+            _rendered.clear()
+
+def _background_refresh() -> None:
+    """Works in a loop to keep the networks list fresh"""
+    while True:
+        time.sleep(NETWORKS_REFRESH_TTL)
+        try:
+            _refresh_networks()
+        except Exception as e:
+            print("Unable to refresh networks list: %s" % e)
+
+def render_index(notification: str, color: str = "ff6666") -> bytes:
+    """Returns the complete index page response, rendered once per networks list"""
+    key = (notification, color)
+    with _networks_lock:
+        page = _rendered.get(key)
+        if page is None:
+            body = (index % (
+                html.escape(color, True),
+                html.escape(notification),
+                html.escape("'"+"', '".join(_networks)+"'"),
+            )).encode()
+            page = _raw_response("200 OK", ["Content-Type: text/html"], body)
+            _rendered[key] = page
+    return page
+
 class Redirect(BaseHTTPRequestHandler):
-    def send_index(self, notification, color = "ff6666"):
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html")
-        self.end_headers()
-        self.wfile.write((index % (
-            html.escape(color, True),
-            html.escape(notification),
-            html.escape("'"+"', '".join(wpaNetworksList())+"'"),
-        )).encode())
+    # Limit the time the slow client could hold the connection
+    timeout = READ_TIMEOUT
+
+    def setup(self):
+        super().setup()
+        # Socket timeout is applied to every read, so the client sending a
+        # byte at a time is cut off by the overall deadline
+        self._deadline = threading.Timer(READ_TIMEOUT, self._expire)
+        self._deadline.daemon = True
+        self._deadline.start()
+
+    def _expire(self) -> None:
+        try:
+            # Reads return EOF, the response could still be sent
+            self.connection.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def finish(self):
+        self._deadline.cancel()
+        super().finish()
+
+    def send_raw(self, data: bytes) -> None:
+        self.log_request(data[9:12].decode())
+        self.wfile.write(data)
+        self.close_connection = True
 
+    def send_index(self, notification, color = "ff6666"):
+        self.send_raw(render_index(notification, color))
 
     def do_GET(self):
-        if self.headers.get('Host') != "setup.teleglobe":
-            self.send_response(302)
-            self.send_header("Location", "http://setup.teleglobe/")
-            self.end_headers()
+        probe = _probe_responses.get(self.path.split("?", 1)[0])
+        if probe is not None:
+            self.send_raw(probe)
+            return
+        if self.headers.get('Host') != SETUP_HOST:
+            self.send_raw(_redirect_response)
             return
         self.send_index("Please put the WiFi name and password to connect to Telegram API", "ffff00")
 
     def do_POST(self):
-        ctype, pdict = parse_header(self.headers.get("Content-Type"))
+        ctype, pdict = parse_header(self.headers.get("Content-Type", ""))
         if ctype != "application/x-www-form-urlencoded":
             self.send_index("ERROR: Incorrect content type")
             return
 
-        length = int(self.headers.get("Content-Length"))
-        if length > 10240:
+        try:
+            length = int(self.headers.get("Content-Length"))
+        except (TypeError, ValueError):
+            self.send_index("ERROR: Unknown request length")
+            return
+        if length < 0 or length > MAX_BODY_SIZE:
             self.send_index("ERROR: Too big request")
+            return
 
-        postvars = parse_qs(self.rfile.read(length), keep_blank_values=1)
-        if not postvars[b"ssid"][0]:
+        body = self.rfile.read(length)
+        if len(body) != length:
+            self.send_index("ERROR: Request timed out")
+            return
+        postvars = parse_qs(body, keep_blank_values=1)
+        if not postvars.get(b"ssid", [b""])[0]:
             self.send_index("ERROR: WiFi SSID can't be empty.")
+            return
 
-        wpaCreateConfig(postvars[b"ssid"][0], postvars[b"password"][0])
+        wpaCreateConfig(postvars[b"ssid"][0], postvars.get(b"password", [b""])[0])
 
         self.send_index("OK config saved. Reboot...", "66ff66")
 
-        _exec(["reboot"])
-
-HTTPServer(("", int(80)), Redirect).serve_forever()
+        # Exit the server - captive portal supervisor will reboot the device
+        threading.Thread(target=self.server.shutdown).start()
+
+class PortalServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, *args, **kwargs):
+        self._handlers = threading.BoundedSemaphore(MAX_HANDLERS)
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        # The deadline frees the slots, so the wait is bounded by READ_TIMEOUT
+        self._handlers.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self._handlers.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._handlers.release()
+
+def main(port: int = 80) -> None:
+    """Serves the setup page, returns when the WiFi config is saved"""
+    _refresh_networks()
+    refresher = threading.Thread(target=_background_refresh)
+    refresher.daemon = True
+    refresher.start()
+
+    with PortalServer(("", port), Redirect) as server:
+        server.serve_forever()
+
+if __name__ == '__main__':
+    main()
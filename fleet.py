@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import hmac
+import time
+import logging
+import threading
+import collections
+import urllib.parse
+import urllib.request
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+import settings
+import metrics
+import album
+
+# Media transfer request size, an interrupted transfer resumes from the last chunk
+CHUNK_SIZE = 1024 * 1024
+# Commands kept by the leader for the reconnecting followers
+EVENTS_KEEP = 100
+# Long poll timeout for the events request
+POLL_TIMEOUT = 30
+# Time given to the followers to get the command before the synchronous show
+SHOW_DELAY = 3.0
+# Conservative Wi-Fi LAN rate to give the followers time to fetch the media
+TRANSFER_RATE = 1024 * 1024
+# How often the followers re-estimate the leader clock offset
+CLOCK_INTERVAL = 300
+# Follower is active if it polled within the poll timeout plus this time
+FOLLOWER_GRACE = 15
+
+_leader = None
+_follower = None
+
+def _prune(directory: str, budget: int) -> None:
+    """Removes the oldest media over the byte budget"""
+    files = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(".part") or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(f[1] for f in files)
+    for _, size, path in sorted(files):
+        if total <= budget:
+            break
+        os.unlink(path)
+        total -= size
+
+class Leader:
+    """Serves the display commands and the received media to the followers
+
+    Protocol is plain HTTP:
+      GET /clock                 - leader monotonic time to estimate the offset
+      GET /events?since=<seq>    - long poll for the commands after seq
+      GET /media/<sha256>        - media content, Range requests to transfer by chunks
+    """
+
+    def __init__(self, address: tuple, media_directory: str, token: str = "", media_bytes: int = 1024 * 1024 * 1024):
+        self.media_directory = media_directory
+        self.media_bytes = media_bytes
+        self.token = token
+        self._events = collections.deque(maxlen=EVENTS_KEEP)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._followers = {}    # address -> last poll time
+        os.makedirs(media_directory, exist_ok=True)
+        self._server = ThreadingHTTPServer(address, _leader_handler(self))
+        self._server.daemon_threads = True
+
+    @property
+    def address(self) -> tuple:
+        return self._server.server_address
+
+    def start(self) -> None:
+        logger.info("Fleet leader listening on %s:%d", *self.address)
+        thread = threading.Thread(target=self._server.serve_forever, name="fleet_leader")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def publish(self, kind: str, path: str, duration: float = 0, delay: float = None) -> float:
+        """Shares the media with the followers, returns the leader time to show it
+
+        By default the show is delayed by the time to transfer the media if
+        any follower is active, the leader alone only waits SHOW_DELAY.
+        """
+        # The received media is just stored to the album, no need to hash again
+        digest = album.known_hash(path) or album.file_hash(path)
+        media = os.path.join(self.media_directory, digest)
+        if not os.path.exists(media):
+            album.link_file(path, media)
+        _prune(self.media_directory, self.media_bytes)
+
+        size = os.path.getsize(media)
+        if delay is None:
+            delay = SHOW_DELAY
+            if self.followers():
+                delay += size / TRANSFER_RATE
+        at = time.monotonic() + delay
+        with self._cond:
+            self._seq += 1
+            self._events.append({
+                "seq": self._seq,
+                "cmd": "show",
+                "kind": kind,
+                "id": digest,
+                "ext": path.rsplit(".", 1)[-1].lower(),
+                "size": size,
+                "duration": duration,
+                "at": at,
+            })
+            self._cond.notify_all()
+        logger.info("Fleet show %s %s at %.1f", kind, digest, at)
+        return at
+
+    def followers(self) -> list:
+        """Addresses of the followers polled recently"""
+        now = time.monotonic()
+        with self._cond:
+            return [a for a, seen in self._followers.items() if now - seen < POLL_TIMEOUT + FOLLOWER_GRACE]
+
+    def events(self, since: (int, None), timeout: float = POLL_TIMEOUT, follower: str = None) -> dict:
+        """Waits for the commands newer than since, None to get the current seq"""
+        with self._cond:
+            if follower is not None:
+                self._followers[follower] = time.monotonic()
+            if since is None:
+                return {"seq": self._seq, "events": []}
+            if since <= self._seq:
+                self._cond.wait_for(lambda: self._seq > since, timeout)
+            if follower is not None:
+                self._followers[follower] = time.monotonic()
+            return {"seq": self._seq, "events": [e for e in self._events if e["seq"] > since]}
+
+    def authorized(self, token: str) -> bool:
+        # No token would share the album with anyone on the LAN
+        return bool(self.token) and hmac.compare_digest(self.token, token or "")
+
+def _leader_handler(leader: Leader):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+        def _json(self, data: dict) -> None:
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _media(self, digest: str) -> None:
+            path = os.path.join(leader.media_directory, digest)
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            with open(path, "rb") as fd:
+                size = os.fstat(fd.fileno()).st_size
+                start, end = 0, size - 1
+                match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+                if match:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2) or end), end)
+                    if start > end:
+                        self.send_error(416)
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                fd.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = fd.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+            metrics.counter("fleet_served_bytes_total").inc(end - start + 1)
+
+        def do_GET(self):
+            if not leader.authorized(self.headers.get("X-Fleet-Token")):
+                self.send_error(403)
+                return
+            url = urllib.parse.urlsplit(self.path)
+            if url.path == "/clock":
+                self._json({"monotonic": time.monotonic()})
+            elif url.path == "/events":
+                query = urllib.parse.parse_qs(url.query)
+                try:
+                    since = int(query["since"][0]) if "since" in query else None
+                except ValueError:
+                    self.send_error(400)
+                    return
+                self._json(leader.events(since, follower=self.client_address[0]))
+            elif re.fullmatch(r"/media/[0-9a-f]{64}", url.path):
+                self._media(url.path.rsplit("/", 1)[1])
+            else:
+                self.send_error(404)
+
+    return Handler
+
+class Follower:
+    """Follows the leader commands, fetches the media and shows it on schedule"""
+
+    def __init__(self, leader_url: str, media_directory: str, show, token: str = "", media_bytes: int = 1024 * 1024 * 1024):
+        self.leader_url = leader_url.rstrip("/")
+        self.media_directory = media_directory
+        self.media_bytes = media_bytes
+        self.token = token
+        self.offset = None
+        self._show = show
+        self._since = None
+        self._stopped = threading.Event()
+        self._clock_synced = 0.0
+        # Fetches share the partial files, shows share the display
+        self._fetch_lock = threading.Lock()
+        self._show_lock = threading.Lock()
+        os.makedirs(media_directory, exist_ok=True)
+
+    def _request(self, path: str, headers: dict = {}, timeout: float = 10):
+        headers = dict(headers, **{"X-Fleet-Token": self.token})
+        return urllib.request.urlopen(urllib.request.Request(self.leader_url + path, headers=headers), timeout=timeout)
+
+    def sync_clock(self, samples: int = 5) -> float:
+        """Estimates the leader clock offset using the fastest round trip"""
+        best = None
+        for _ in range(samples):
+            t0 = time.monotonic()
+            with self._request("/clock") as resp:
+                remote = json.load(resp)["monotonic"]
+            t1 = time.monotonic()
+            if best is None or t1 - t0 < best[0]:
+                best = (t1 - t0, remote - (t0 + t1) / 2)
+        self.offset = best[1]
+        self._clock_synced = time.monotonic()
+        logger.info("Fleet clock offset %.4fs (rtt %.4fs)", self.offset, best[0])
+        return self.offset
+
+    def local_time(self, leader_time: float) -> float:
+        return leader_time - self.offset
+
+    def fetch(self, event: dict) -> str:
+        """Downloads the media by chunks, continuing the partial file if any"""
+        path = os.path.join(self.media_directory, event["id"] + "." + event["ext"])
+        if os.path.exists(path):
+            return path
+        part = os.path.join(self.media_directory, event["id"] + ".part")
+        size = event["size"]
+        with open(part, "ab") as fd:
+            pos = fd.tell()
+            failures = 0
+            while pos < size:
+                end = min(pos + CHUNK_SIZE, size) - 1
+                try:
+                    with self._request("/media/" + event["id"], {"Range": "bytes=%d-%d" % (pos, end)}) as resp:
+                        while True:
+                            chunk = resp.read(64 * 1024)
+                            if not chunk:
+                                break
+                            fd.write(chunk)
+                            pos += len(chunk)
+                            metrics.counter("fleet_fetched_bytes_total").inc(len(chunk))
+                    failures = 0
+                except OSError as e:
+                    failures += 1
+                    if failures > 5:
+                        raise
+                    logger.warning("Fleet fetch of %s failed at %d: %s, retry", event["id"], pos, e)
+                    fd.flush()
+                    time.sleep(min(2 ** failures, 30))
+
+        if album.file_hash(part) != event["id"]:
+            os.unlink(part)
+            raise Exception("Fleet media %s is corrupted" % event["id"])
+        os.replace(part, path)
+        _prune(self.media_directory, self.media_bytes)
+        return path
+
+    def handle(self, event: dict) -> None:
+        """Fetches the media and shows it at the leader scheduled time"""
+        if event.get("cmd") != "show":
+            return
+        with self._fetch_lock:
+            path = self.fetch(event)
+        delay = self.local_time(event["at"]) - time.monotonic()
+        metrics.histogram("fleet_show_lateness_seconds").observe(max(0.0, -delay))
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            logger.warning("Fleet show of %s is late by %.2fs", event["id"], -delay)
+        with self._show_lock:
+            self._show(event["kind"], path, event.get("duration", 0))
+
+    def _handle_safe(self, event: dict) -> None:
+        try:
+            self.handle(event)
+        except Exception as e:
+            logger.error("Fleet command %s failed: %s", event, e)
+
+    def poll(self) -> None:
+        """Gets and handles the new leader commands once"""
+        if self.offset is None or time.monotonic() - self._clock_synced > CLOCK_INTERVAL:
+            self.sync_clock()
+        query = "?since=%d" % self._since if self._since is not None else ""
+        with self._request("/events" + query, timeout=POLL_TIMEOUT + 10) as resp:
+            data = json.load(resp)
+        if self._since is None or data["seq"] < self._since:
+            # Just connected or the leader restarted - skip the old commands
+            self._since = data["seq"]
+            return
+        for event in data["events"]:
+            self._since = event["seq"]
+            # The poll continues while the media is fetched and shown
+            thread = threading.Thread(target=self._handle_safe, args=(event,), name="fleet_show")
+            thread.daemon = True
+            thread.start()
+
+    def _run(self) -> None:
+        """Works in a loop to follow the leader"""
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+                failures = 0
+            except (OSError, ValueError, KeyError) as e:
+                failures += 1
+                logger.warning("Fleet leader %s is not available: %s", self.leader_url, e)
+                self._stopped.wait(min(2 ** failures, 60))
+
+    def start(self) -> None:
+        logger.info("Fleet follower of %s", self.leader_url)
+        thread = threading.Thread(target=self._run, name="fleet_follower")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+def _config() -> dict:
+    return settings.get("fleet", {})
+
+def _token() -> str:
+    token = _config().get("token")
+    if not token:
+        raise Exception("Fleet mode requires the non-empty fleet.token setting")
+    return token
+
+def role() -> (str, None):
+    """"leader", "follower" or None if the fleet mode is disabled"""
+    return _config().get("role")
+
+def init_leader() -> None:
+    global _leader
+    cfg = _config()
+    token = _token()
+    host, port = cfg.get("listen", "0.0.0.0:8765").rsplit(":", 1)
+    _leader = Leader((host, int(port)), cfg.get("media_directory", "fleet_media"), token, cfg.get("media_bytes", 1024 * 1024 * 1024))
+    _leader.start()
+
+def init_follower(show) -> None:
+    global _follower
+    cfg = _config()
+    token = _token()
+    _follower = Follower(cfg["leader"], cfg.get("media_directory", "fleet_media"), show, token, cfg.get("media_bytes", 1024 * 1024 * 1024))
+    _follower.start()
+
+def publish(kind: str, path: str, duration: float = 0) -> (float, None):
+    """Sends the media to the followers if leader, returns the show time"""
+    if _leader is None:
+        return None
+    return _leader.publish(kind, path, duration)
+
+def wait_until(at: (float, None)) -> None:
+    """Waits for the synchronous show time returned by publish"""
+    if at is not None:
+        time.sleep(max(0.0, at - time.monotonic()))
@@ -4,6 +4,9 @@ import os, sys
 import logging
 import subprocess
 import atexit
+import time
+
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +29,15 @@ SUPPORTED_VIDEOS = {
     "mts", "m2ts", "ts",
 }
 
+def _spawn(cmd: list) -> subprocess.Popen:
+    """Starts the process and records the spawn metrics"""
+    program = os.path.basename(cmd[0])
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd)
+    metrics.histogram("process_spawn_seconds", program=program).observe(time.monotonic() - start)
+    metrics.counter("process_spawn_total", program=program).inc()
+    return proc
+
 def screen_size() -> dict:
     return _screen_size
 
@@ -41,7 +53,7 @@ def show_image(path: str, wait_sec: int = 0, center: bool = False) -> subprocess
     # TODO: modify omxiv to control the image position and make animated movement
     logger.info("Show image file: %s", path)
     cleanup_display()
-    proc = subprocess.Popen([os.path.join(os.path.dirname(os.path.realpath(__file__)), "omxiv"),
+    proc = _spawn([os.path.join(os.path.dirname(os.path.realpath(__file__)), "omxiv"),
         "--blank", "-T", "blend",
         "--aspect", "center" if center else "letterbox",
         path,
@@ -66,11 +78,11 @@ def show_video(path: str, wait_sec: int = 0, volume: int = 100) -> subprocess.Po
     cleanup_display()
     # If no audio available omxplayer will not play anything
     if _audio_detected:
-        proc = subprocess.Popen(["omxplayer",
+        proc = _spawn(["omxplayer",
             "--adev", "alsa", "--vol", str(volume*60-6000), path,
         ])
     else:
-        proc = subprocess.Popen(["omxplayer",
+        proc = _spawn(["omxplayer",
             path,
         ])
     if wait_sec > 0:
@@ -101,7 +113,7 @@ def play_audio(path: str, wait_sec: int = 0, volume: int = 100) -> (None, subpro
         os.unlink("./omxaudio")
     os.symlink("/usr/bin/omxplayer.bin", "./omxaudio")
 
-    proc = subprocess.Popen(["./omxaudio",
+    proc = _spawn(["./omxaudio",
         "--adev", "alsa", "--vol", str(volume*60-6000), path,
     ])
     if wait_sec > 0:
@@ -130,14 +142,14 @@ def show_update_progress() -> subprocess.Popen:
 
 def cleanup_display() -> None:
     """Clean up display running processes"""
-    proc = subprocess.Popen(["pkill", "omxplayer"])
+    proc = _spawn(["pkill", "omxplayer"])
     proc.communicate()
-    proc = subprocess.Popen(["pkill", "omxiv"])
+    proc = _spawn(["pkill", "omxiv"])
     proc.communicate()
 
 def cleanup_audio() -> None:
     """Clean up audio running processes"""
-    proc = subprocess.Popen(["pkill", "omxaudio"])
+    proc = _spawn(["pkill", "omxaudio"])
     proc.communicate()
 
 def cleanup() -> None:
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import queue
+import atexit
+import logging
+import threading
+import collections
+
+from logging.handlers import QueueHandler, QueueListener
+
+import settings
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener = None
+_ring = None
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last records in memory to get them without journalctl"""
+
+    def __init__(self, capacity: int = 1000):
+        super().__init__()
+        self._records = collections.deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self._records.append(record)
+
+    def records(self, level: int = logging.NOTSET, count: int = 0) -> list:
+        """Returns up to count of the latest records with level or higher"""
+        records = [r for r in list(self._records) if r.levelno >= level]
+        return records[-count:] if count > 0 else records
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per logger name to drop the noisy sources flood
+
+    Warnings and errors are always passed. The number of dropped records is
+    added to the next passed one for the same logger.
+    """
+
+    def __init__(self, limits: dict, burst: int = 10):
+        super().__init__()
+        self._limits = limits
+        self._burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, name: str) -> (float, None):
+        while name:
+            if name in self._limits:
+                return self._limits[name]
+            name = name.rpartition('.')[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._limit(record.name)
+        if rate is None:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, dropped = self._buckets.get(record.name, (self._burst, now, 0))
+            tokens = min(self._burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self._buckets[record.name] = (tokens, now, dropped + 1)
+                return False
+            self._buckets[record.name] = (tokens - 1, now, 0)
+
+        if dropped:
+            record.msg = '(%d suppressed) %s' % (dropped, record.msg)
+        return True
+
+def setup() -> None:
+    """Moves the log output to the background thread
+
+    Records are passed through the queue to the listener thread, so the
+    caller is not waiting for the slow stdout/journald write.
+    """
+    global _listener, _ring
+    if _listener is not None:
+        return
+
+    cfg = settings.get("logging", {})
+
+    formatter = logging.Formatter(FORMAT)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(formatter)
+    _ring = RingBufferHandler(cfg.get("buffer_size", 1000))
+
+    log_queue = queue.SimpleQueue()
+    handler = QueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(cfg.get("rate_limits", {
+        "slideshow": 1.0,
+        "interface": 1.0,
+    }), cfg.get("rate_burst", 10)))
+
+    root = logging.getLogger()
+    root.setLevel(logging.getLevelName(cfg.get("level", "INFO")))
+    root.addHandler(handler)
+
+    _listener = QueueListener(log_queue, stream, _ring, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+def recent(level: int = logging.NOTSET, count: int = 50, max_chars: int = 0) -> list:
+    """Returns the latest formatted log lines from memory
+
+    With max_chars the oldest lines are dropped, so the lines joined by new
+    line fit into it. The only line longer than that is cut at the end.
+    """
+    if _ring is None:
+        return []
+    formatter = logging.Formatter(FORMAT)
+    lines = [formatter.format(r) for r in _ring.records(level, count)]
+    if max_chars <= 0:
+        return lines
+    kept = []
+    size = -1
+    for line in reversed(lines):
+        size += len(line) + 1
+        if size > max_chars:
+            if not kept:
+                kept.append(line[:max_chars])
+            break
+        kept.append(line)
+    return kept[::-1]
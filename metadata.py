@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import queue
+import bisect
+import struct
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+import settings
+import metrics
+import power
+
+# Seconds between 1904-01-01 (MP4 epoch) and 1970-01-01
+MP4_EPOCH_OFFSET = 2082844800
+# Max bytes read from the TIFF file header
+TIFF_HEADER_SIZE = 256 * 1024
+
+# Exif tags
+TAG_WIDTH = 0x0100
+TAG_HEIGHT = 0x0101
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_PIXEL_X = 0xA002
+TAG_PIXEL_Y = 0xA003
+
+_TIFF_TYPES = {1: "B", 2: "s", 3: "H", 4: "L", 7: "B", 9: "l"}
+_TIFF_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 7: 1, 9: 4}
+
+# Rotation matrix (a, b, c, d) of the MP4 track header -> EXIF orientation
+_MP4_ORIENTATION = {
+    (0x10000, 0, 0, 0x10000): 1,
+    (0, 0x10000, -0x10000, 0): 6,
+    (-0x10000, 0, 0, -0x10000): 3,
+    (0, -0x10000, 0x10000, 0): 8,
+}
+
+_lock = threading.Lock()
+_records = {}        # path -> record
+_by_time = []        # sorted (time, path)
+_by_day = []         # sorted (MMDD, time, path)
+_queue = queue.Queue()
+_feeder_thread = None
+_journal = None
+
+def _parse_exif_time(value: str) -> (float, None):
+    try:
+        return time.mktime(time.strptime(value.strip("\x00 ")[:19], "%Y:%m:%d %H:%M:%S"))
+    except (ValueError, OverflowError):
+        return None
+
+def _parse_tiff(data: bytes) -> dict:
+    """Reads the interesting tags out of the TIFF structure (Exif payload)"""
+    if data[:2] == b"II":
+        endian = "<"
+    elif data[:2] == b"MM":
+        endian = ">"
+    else:
+        return {}
+    if struct.unpack_from(endian + "H", data, 2)[0] != 42:
+        return {}
+
+    def read_ifd(offset: int) -> dict:
+        tags = {}
+        if offset + 2 > len(data):
+            return tags
+        count = struct.unpack_from(endian + "H", data, offset)[0]
+        for i in range(count):
+            entry = offset + 2 + i * 12
+            if entry + 12 > len(data):
+                break
+            tag, typ, num = struct.unpack_from(endian + "HHL", data, entry)
+            if typ not in _TIFF_TYPES:
+                continue
+            size = _TIFF_SIZES[typ] * num
+            pos = entry + 8
+            if size > 4:
+                pos = struct.unpack_from(endian + "L", data, pos)[0]
+            if pos + size > len(data):
+                continue
+            if typ == 2:
+                tags[tag] = data[pos:pos + size].decode("ascii", "replace")
+            else:
+                tags[tag] = struct.unpack_from(endian + _TIFF_TYPES[typ] * num, data, pos)[0]
+        return tags
+
+    ifd0 = read_ifd(struct.unpack_from(endian + "L", data, 4)[0])
+    exif = read_ifd(ifd0[TAG_EXIF_IFD]) if isinstance(ifd0.get(TAG_EXIF_IFD), int) else {}
+
+    ret = {}
+    captured = exif.get(TAG_DATETIME_ORIGINAL) or ifd0.get(TAG_DATETIME)
+    if isinstance(captured, str):
+        ret["time"] = _parse_exif_time(captured)
+    if isinstance(ifd0.get(TAG_ORIENTATION), int):
+        ret["orientation"] = ifd0[TAG_ORIENTATION]
+    width = exif.get(TAG_PIXEL_X) or ifd0.get(TAG_WIDTH)
+    height = exif.get(TAG_PIXEL_Y) or ifd0.get(TAG_HEIGHT)
+    if width and height:
+        ret["width"], ret["height"] = width, height
+    return ret
+
+def read_jpeg(fd) -> dict:
+    """Walks the JPEG segments headers up to the frame header"""
+    if fd.read(2) != b"\xff\xd8":
+        return {}
+    ret = {}
+    while True:
+        marker = fd.read(2)
+        while marker[:1] == b"\xff" and marker[1:] == b"\xff":
+            marker = marker[1:] + fd.read(1)
+        if len(marker) < 2 or marker[0] != 0xff or marker[1] == 0xda:
+            break
+        length = fd.read(2)
+        if len(length) < 2:
+            break
+        length = struct.unpack(">H", length)[0] - 2
+        code = marker[1]
+        if code == 0xe1 and "time" not in ret:
+            segment = fd.read(length)
+            if segment[:6] == b"Exif\x00\x00":
+                exif = _parse_tiff(segment[6:])
+                exif.update({k: v for k, v in ret.items() if k in ("width", "height")})
+                ret = exif
+            continue
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack(">xHH", fd.read(5))
+            ret["width"], ret["height"] = width, height
+            break
+        fd.seek(length, os.SEEK_CUR)
+    return ret
+
+def read_tiff(fd) -> dict:
+    return _parse_tiff(fd.read(TIFF_HEADER_SIZE))
+
+def _mp4_boxes(fd, start: int, end: int):
+    """Iterates over the MP4 boxes (type, content start, box end) in range"""
+    pos = start
+    while pos + 8 <= end:
+        fd.seek(pos)
+        header = fd.read(8)
+        if len(header) < 8:
+            return
+        size, typ = struct.unpack(">L4s", header)
+        offset = 8
+        if size == 1:
+            size = struct.unpack(">Q", fd.read(8))[0]
+            offset = 16
+        elif size == 0:
+            size = end - pos
+        if size < offset:
+            return
+        yield typ, pos + offset, pos + size
+        pos += size
+
+def read_mp4(fd) -> dict:
+    """Reads the movie and track headers without touching the media data"""
+    ret = {}
+    end = fd.seek(0, os.SEEK_END)
+    for typ, start, stop in _mp4_boxes(fd, 0, end):
+        if typ != b"moov":
+            continue
+        for typ, start, stop in _mp4_boxes(fd, start, stop):
+            if typ == b"mvhd":
+                fd.seek(start)
+                version = fd.read(4)[0]
+                created = struct.unpack(">Q" if version else ">L", fd.read(8 if version else 4))[0]
+                if created > MP4_EPOCH_OFFSET:
+                    ret["time"] = float(created - MP4_EPOCH_OFFSET)
+            elif typ == b"trak" and "width" not in ret:
+                for typ, start, stop in _mp4_boxes(fd, start, stop):
+                    if typ != b"tkhd":
+                        continue
+                    fd.seek(start)
+                    version = fd.read(4)[0]
+                    fd.seek(start + (36 if version else 24) + 16)
+                    matrix = struct.unpack(">9l", fd.read(36))
+                    width, height = struct.unpack(">LL", fd.read(8))
+                    if width and height:
+                        ret["width"], ret["height"] = width >> 16, height >> 16
+                        ret["orientation"] = _MP4_ORIENTATION.get((matrix[0], matrix[1], matrix[3], matrix[4]), 1)
+        break
+    return ret
+
+_READERS = {
+    "jpg": read_jpeg, "jpeg": read_jpeg,
+    "tiff": read_tiff, "tif": read_tiff,
+    "mp4": read_mp4, "m4v": read_mp4, "mov": read_mp4,
+}
+
+def extract(path: str) -> dict:
+    """Reads the media header and returns the metadata record
+
+    Capture time falls back to the file modification time.
+    """
+    stat = os.stat(path)
+    record = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    reader = _READERS.get(path.rsplit(".", 1)[-1].lower())
+    if reader is not None:
+        try:
+            with open(path, "rb") as fd:
+                record.update(reader(fd))
+        except (OSError, struct.error, IndexError) as e:
+            logger.debug("Unable to read metadata of %s: %s", path, e)
+    if not record.get("time"):
+        record["time"] = stat.st_mtime
+    return record
+
+def _day(timestamp: float) -> str:
+    return time.strftime("%m%d", time.localtime(timestamp))
+
+def _index(record: dict) -> None:
+    """Puts the record into the sorted indexes, replacing the old one"""
+    path = record["path"]
+    with _lock:
+        _unindex(path)
+        _records[path] = record
+        bisect.insort(_by_time, (record["time"], path))
+        bisect.insort(_by_day, (_day(record["time"]), record["time"], path))
+
+def _unindex(path: str) -> None:
+    old = _records.pop(path, None)
+    if old is None:
+        return
+    for index, key in ((_by_time, (old["time"], path)), (_by_day, (_day(old["time"]), old["time"], path))):
+        pos = bisect.bisect_left(index, key)
+        if pos < len(index) and index[pos] == key:
+            del index[pos]
+
+def _journal_path() -> str:
+    return settings.get("metadata", {}).get("journal", "metadata.jsonl")
+
+def _persist(record: dict) -> None:
+    """Appends the record to the journal, so the progress is never lost"""
+    with _lock:
+        _journal.write(json.dumps(record) + "\n")
+        _journal.flush()
+
+def forget(path: str) -> None:
+    """Removes the path from the indexes"""
+    with _lock:
+        if path in _records:
+            _unindex(path)
+            if _journal is not None:
+                _journal.write(json.dumps({"path": path, "deleted": True}) + "\n")
+                _journal.flush()
+
+def prune(paths: set) -> None:
+    """Forgets the paths which are not in the album anymore"""
+    for path in [p for p in list(_records) if p not in paths]:
+        forget(path)
+
+def queue_extract(path: str) -> None:
+    """Schedules the metadata extraction in background"""
+    _queue.put(path)
+
+def load() -> None:
+    """Replays the journal and compacts it"""
+    global _journal
+    path = _journal_path()
+    records = {}
+    try:
+        with open(path, "r") as fd:
+            for line in fd:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # Partially written line
+                if record.get("deleted"):
+                    records.pop(record["path"], None)
+                else:
+                    records[record["path"]] = record
+    except FileNotFoundError:
+        pass
+    # Sorting once instead of inserting one by one, the album could be big
+    with _lock:
+        _records.clear()
+        _records.update(records)
+        _by_time[:] = sorted((r["time"], p) for p, r in records.items())
+        _by_day[:] = sorted((_day(r["time"]), r["time"], p) for p, r in records.items())
+
+    with open(path + ".tmp", "w") as fd:
+        for record in records.values():
+            fd.write(json.dumps(record) + "\n")
+    os.replace(path + ".tmp", path)
+    _journal = open(path, "a")
+    logger.info("Loaded metadata for %d files", len(records))
+
+def _idle_priority() -> None:
+    """Pool worker initializer: do not compete with the display"""
+    os.nice(19)
+
+def _done(future) -> None:
+    try:
+        record = future.result()
+    except Exception as e:
+        logger.warning("Metadata extraction failed: %s", e)
+        return
+    _index(record)
+    _persist(record)
+    metrics.counter("metadata_extracted_total").inc()
+
+def _background_feeder() -> None:
+    """Works in a loop to pass the queued paths to the bounded process pool"""
+    workers = settings.get("metadata", {}).get("workers", 1)
+    # Fork is used since spawn would import the main teleglobe module again
+    context = multiprocessing.get_context("fork")
+    pool = None
+    # Backpressure: do not keep more than that in the pool queue
+    in_flight = threading.BoundedSemaphore(workers * 2)
+    while True:
+        path = _queue.get()
+        power.wait_awake()
+        record = _records.get(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            forget(path)
+            continue
+        if record is not None and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime_ns:
+            continue
+        in_flight.acquire()
+        if pool is None:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_idle_priority)
+        try:
+            future = pool.submit(extract, path)
+        except BrokenProcessPool:
+            # The worker was killed (OOM for example), so starting the new pool
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_idle_priority)
+            future = pool.submit(extract, path)
+        future.add_done_callback(_done)
+        future.add_done_callback(lambda f: in_flight.release())
+
+def init() -> None:
+    """Loads the metadata and starts the background extraction"""
+    global _feeder_thread
+    if _feeder_thread is not None:
+        return
+    load()
+    _feeder_thread = threading.Thread(target=_background_feeder, name="metadata")
+    _feeder_thread.daemon = True
+    _feeder_thread.start()
+
+def next_chronological(path: (str, None)) -> (str, None):
+    """Returns the path captured right after the given one, wraps around"""
+    with _lock:
+        if not _by_time:
+            return None
+        record = _records.get(path)
+        pos = bisect.bisect_right(_by_time, (record["time"], path)) if record else 0
+        return _by_time[pos % len(_by_time)][1]
+
+def next_on_this_day(path: (str, None), now: float = None) -> (str, None):
+    """Returns the next path captured on this day of the past years"""
+    day = _day(time.time() if now is None else now)
+    with _lock:
+        start = bisect.bisect_left(_by_day, (day,))
+        stop = bisect.bisect_left(_by_day, (day + "\x00",))
+        if start == stop:
+            return None
+        record = _records.get(path)
+        pos = start
+        if record is not None and _day(record["time"]) == day:
+            pos = bisect.bisect_right(_by_day, (day, record["time"], path))
+        return _by_day[start + (pos - start) % (stop - start)][2]
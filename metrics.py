@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+_exporter_thread = None
+
+class Counter:
+    """Monotonically increasing value"""
+    kind = "counter"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+class Gauge:
+    """Value that could go up and down"""
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+class Histogram:
+    """Observations counted in the fixed buckets"""
+    kind = "histogram"
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    index = i
+                    break
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+            self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket containing the q quantile"""
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for i, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+def _get(cls, name: str, labels: dict, *args):
+    key = (name, tuple(sorted(labels.items())))
+    metric = _metrics.get(key)
+    if metric is None:
+        with _metrics_lock:
+            metric = _metrics.get(key)
+            if metric is None:
+                metric = cls(*args)
+                _metrics[key] = metric
+    if not isinstance(metric, cls):
+        raise TypeError("Metric %s is already registered as %s" % (name, metric.kind))
+    return metric
+
+def counter(name: str, **labels) -> Counter:
+    return _get(Counter, name, labels)
+
+def gauge(name: str, **labels) -> Gauge:
+    return _get(Gauge, name, labels)
+
+def histogram(name: str, buckets: tuple = DEFAULT_BUCKETS, **labels) -> Histogram:
+    return _get(Histogram, name, labels, buckets)
+
+@contextlib.contextmanager
+def timed(name: str, **labels):
+    """Observes the block execution time in seconds histogram"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        histogram(name, **labels).observe(time.monotonic() - start)
+
+def _labels_str(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+def summary() -> str:
+    """Returns compact human readable summary of all the metrics"""
+    lines = []
+    for (name, labels), metric in sorted(list(_metrics.items()), key=lambda i: i[0]):
+        if metric.kind == "histogram":
+            if metric.count == 0:
+                continue
+            lines.append("%s%s n=%d avg=%.3g p50<=%.3g p95<=%.3g max=%.3g" % (
+                name, _labels_str(labels), metric.count, metric.sum / metric.count,
+                metric.quantile(0.5), metric.quantile(0.95), metric.max,
+            ))
+        else:
+            lines.append("%s%s %.6g" % (name, _labels_str(labels), metric.value))
+    return "\n".join(lines)
+
+def _value_str(value) -> str:
+    """Exact text of the sample value, integers without the exponent"""
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    if isinstance(value, int) or float(value).is_integer() and abs(value) < 2 ** 53:
+        return "%d" % value
+    return repr(float(value))
+
+def exposition() -> str:
+    """Returns the metrics in Prometheus text exposition format"""
+    lines = []
+    typed = set()
+    for (name, labels), metric in sorted(list(_metrics.items()), key=lambda i: i[0]):
+        full = "teleglobe_" + name
+        if full not in typed:
+            lines.append("# TYPE %s %s" % (full, metric.kind))
+            typed.add(full)
+        if metric.kind == "histogram":
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ("+Inf",), metric.counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (full, _labels_str(labels + (("le", bound),)), cumulative))
+            lines.append("%s_sum%s %s" % (full, _labels_str(labels), _value_str(metric.sum)))
+            lines.append("%s_count%s %d" % (full, _labels_str(labels), metric.count))
+        else:
+            lines.append("%s%s %s" % (full, _labels_str(labels), _value_str(metric.value)))
+    return "\n".join(lines) + "\n"
+
+def write_textfile(path: str) -> None:
+    """Atomically writes exposition file for node_exporter textfile collector"""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fd:
+        fd.write(exposition())
+    os.replace(tmp, path)
+
+def _background_exporter(path: str, interval: float) -> None:
+    """Works in a loop to update the textfile"""
+    while True:
+        try:
+            write_textfile(path)
+        except OSError as e:
+            logger.warning("Unable to write metrics file %s: %s", path, e)
+        time.sleep(interval)
+
+def start_exporter(path: str, interval: float = 60) -> None:
+    """Starts the background thread to update node_exporter textfile"""
+    global _exporter_thread
+    if _exporter_thread is not None:
+        return
+    logger.info("Writing metrics to %s every %ds", path, interval)
+    _exporter_thread = threading.Thread(target=_background_exporter, args=(path, interval))
+    _exporter_thread.daemon = True
+    _exporter_thread.start()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import time
+import random
+import contextlib
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+import settings
+import metrics
+
+THERMAL_PATH = "/sys/class/thermal/thermal_zone0/temp"
+THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+
+# Throttled flags bits: under-voltage, freq capped, throttled, soft temp limit
+THROTTLED_NOW_MASK = 0xf
+
+_lock = threading.Lock()
+# Reentrant, the callbacks could ask for the state again
+_transition_lock = threading.RLock()
+_wakeup = threading.Event()
+_thread = None
+_asleep = False
+_overheated = False
+_awake_until = 0.0
+_holds = 0
+_temperature = None
+_throttled = 0
+_awake = threading.Event()
+_awake.set()
+_on_sleep = None
+_on_wake = None
+
+def _config() -> dict:
+    return settings.get("power", {})
+
+def read_temperature() -> (float, None):
+    """SoC temperature in Celsius"""
+    try:
+        with open(THERMAL_PATH, "r") as fd:
+            return int(fd.read().strip()) / 1000.0
+    except (OSError, ValueError):
+        return None
+
+def read_throttled() -> int:
+    """Firmware throttling flags (see vcgencmd get_throttled)"""
+    try:
+        with open(THROTTLED_PATH, "r") as fd:
+            return int(fd.read().strip(), 16)
+    except (OSError, ValueError):
+        pass
+    try:
+        out = subprocess.run(["vcgencmd", "get_throttled"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=5).stdout
+        return int(out.decode().strip().split("=", 1)[1], 16)
+    except (OSError, ValueError, IndexError, subprocess.TimeoutExpired):
+        return 0
+
+def _minutes(value: str) -> int:
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+def in_schedule(now: float = None) -> bool:
+    """True if the local time is in one of the configured sleep windows"""
+    local = time.localtime(time.time() if now is None else now)
+    current = local.tm_hour * 60 + local.tm_min
+    for window in _config().get("sleep", []):
+        start, end = _minutes(window["from"]), _minutes(window["to"])
+        if start <= end:
+            if start <= current < end:
+                return True
+        elif current >= start or current < end:
+            # The window goes over midnight
+            return True
+    return False
+
+def temperature() -> (float, None):
+    return _temperature
+
+def heat() -> float:
+    """0 when cool, up to 1 at the temperature ceiling or when throttled"""
+    if _throttled & THROTTLED_NOW_MASK:
+        # The firmware is already limiting the SoC, so the load is reduced fully
+        return 1.0
+    if _temperature is None:
+        return 0.0
+    warm = _config().get("warm_temp", 60)
+    ceiling = _config().get("max_temp", 75)
+    if ceiling <= warm:
+        return 0.0
+    return min(1.0, max(0.0, (_temperature - warm) / (ceiling - warm)))
+
+def display_time(seconds: float) -> float:
+    """Image display time stretched up to max_display_factor as it heats up"""
+    return seconds * (1 + heat() * (_config().get("max_display_factor", 3) - 1))
+
+def skip_video() -> bool:
+    """Prefer still images when hot: the higher heat the less videos"""
+    # Never skip all of them, the album could contain videos only
+    return random.random() < min(heat(), 0.9)
+
+def is_asleep() -> bool:
+    return _asleep
+
+def wait_awake(timeout: float = None) -> bool:
+    """Blocks the background preprocessing while the globe is sleeping"""
+    return _awake.wait(timeout)
+
+def wake() -> None:
+    """Wakes up the globe immediately for wake_time (incoming media)"""
+    global _awake_until
+    with _lock:
+        _awake_until = time.monotonic() + _config().get("wake_time", 300)
+    _wakeup.set()
+    _update()
+
+@contextlib.contextmanager
+def awake():
+    """Keeps the globe awake while the requested media is shown"""
+    global _holds
+    with _lock:
+        _holds += 1
+    try:
+        wake()
+        yield
+    finally:
+        with _lock:
+            _holds -= 1
+        _update()
+
+def _update() -> None:
+    """Applies the sleep state according to the schedule and temperature"""
+    global _asleep, _overheated
+    # The display actions must not interleave, so the state is checked and
+    # applied with the callbacks under the same lock
+    with _transition_lock:
+        with _lock:
+            ceiling = _config().get("max_temp", 75)
+            if _temperature is not None:
+                # Hysteresis to not flip the display on the ceiling
+                if _temperature >= ceiling:
+                    _overheated = True
+                elif _temperature < ceiling - _config().get("hysteresis", 5):
+                    _overheated = False
+
+            sleep = (_overheated or in_schedule()) and not _holds and time.monotonic() >= _awake_until
+            if sleep == _asleep:
+                return
+            _asleep = sleep
+
+        metrics.gauge("power_asleep").set(int(sleep))
+        if sleep:
+            logger.info("Going to sleep (temperature %s, overheated %s)", _temperature, _overheated)
+            _awake.clear()
+            if _on_sleep:
+                _on_sleep()
+        else:
+            logger.info("Waking up (temperature %s)", _temperature)
+            _awake.set()
+            if _on_wake:
+                _on_wake()
+
+def _background_monitor() -> None:
+    """Works in a loop to check the temperature and the schedule"""
+    global _temperature, _throttled
+    while True:
+        _temperature = read_temperature()
+        throttled = read_throttled()
+        if throttled & THROTTLED_NOW_MASK and not _throttled & THROTTLED_NOW_MASK:
+            logger.warning("SoC is throttled: 0x%x, temperature %s", throttled, _temperature)
+        _throttled = throttled
+        if _temperature is not None:
+            metrics.gauge("power_temperature_celsius").set(_temperature)
+        metrics.gauge("power_throttled_flags").set(_throttled)
+
+        try:
+            _update()
+        except Exception as e:
+            logger.error("Unable to update the power state: %s", e)
+
+        _wakeup.wait(_config().get("interval", 10))
+        _wakeup.clear()
+
+def init(on_sleep = None, on_wake = None) -> None:
+    """Starts the background monitor with the sleep/wake actions"""
+    global _thread, _on_sleep, _on_wake
+    if _thread is not None:
+        return
+    _on_sleep, _on_wake = on_sleep, on_wake
+    _thread = threading.Thread(target=_background_monitor, name="power")
+    _thread.daemon = True
+    _thread.start()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import math
+import time
+import logging
+import threading
+import collections
+
+logger = logging.getLogger(__name__)
+
+# Max sampling duration
+MAX_DURATION = 300
+# Sampling interval to start with
+INTERVAL = 0.01
+# Max part of the time the sampler could spend on itself
+MAX_OVERHEAD = 0.03
+
+_lock = threading.Lock()
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+
+def _collect(stacks: collections.Counter, skip: int) -> None:
+    """Records the current stack of every thread except the sampler one"""
+    names = {t.ident: t.name for t in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+        if ident == skip:
+            continue
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        stack.append(names.get(ident, str(ident)).replace(" ", "_"))
+        stacks[";".join(reversed(stack))] += 1
+
+def sample(duration: float, interval: float = INTERVAL, max_overhead: float = MAX_OVERHEAD) -> (tuple, None):
+    """Samples all the threads stacks and returns (collapsed stacks, stats line)
+
+    The collapsed stacks could be converted by flamegraph.pl directly. If the
+    sampling takes more than max_overhead part of the wall time, the interval
+    is increased to keep the device responsive. Returns None if the sampling
+    is already in progress.
+    """
+    if not _lock.acquire(blocking=False):
+        return None
+    try:
+        # At least one sample, nan would never end the loop
+        if math.isnan(duration) or duration < interval:
+            duration = interval
+        duration = min(duration, MAX_DURATION)
+        stacks = collections.Counter()
+        me = threading.get_ident()
+        samples = 0
+        spent = 0.0
+        logger.info("Profiling for %.1fs with %.3fs interval", duration, interval)
+
+        start = time.monotonic()
+        end = start + duration
+        while True:
+            before = time.monotonic()
+            if before >= end:
+                break
+            _collect(stacks, me)
+            took = time.monotonic() - before
+            samples += 1
+            spent += took
+            # Overhead guard: keep the sampling cost below the limit
+            if took > interval * max_overhead:
+                interval = took / max_overhead
+            time.sleep(max(0.0, min(interval - took, end - time.monotonic())))
+
+        elapsed = time.monotonic() - start
+        stats = "samples: %d, duration: %.1fs, interval: %.3fs, overhead: %.1f%%" % (
+            samples, elapsed, interval, 100 * spent / elapsed if elapsed else 0)
+        logger.info("Profiling done: %s", stats)
+
+        return "".join("%s %d\n" % (stack, count) for stack, count in stacks.most_common()), stats
+    finally:
+        _lock.release()
@@ -7,11 +7,16 @@ import time
 import atexit
 import random
 import logging
+import collections
 
 logger = logging.getLogger(__name__)
 
 import interface
 import settings
+import metrics
+import album
+import metadata
+import power
 
 _slideshow_active = False
 _slideshow_thread = None
@@ -25,18 +30,40 @@ def make_paths_random() -> list:
     global _current_album_paths
     _current_album_paths = random.sample(list(range(len(_album_paths))), len(_album_paths))
 
+def next_path(last_path: (str, None), skipped: set = frozenset()) -> str:
+    """Picks the next album path according to the slideshow mode
+
+    The skipped paths are not returned by the ordered modes again, so they
+    could not loop over the items which are never shown.
+    """
+    mode = settings.get("slideshow", {}).get("mode", "random")
+    path = None
+    if mode == "chronological":
+        path = metadata.next_chronological(last_path)
+    elif mode == "on_this_day":
+        path = metadata.next_on_this_day(last_path)
+
+    # Fallback to random if the metadata is not ready yet or nothing found
+    if path is None or path not in _album_paths or path in skipped:
+        if not _current_album_paths:
+            make_paths_random()
+        path = list(_album_paths)[_current_album_paths.pop()]
+    return path
+
 def init() -> None:
     """Initialize the background thread"""
     global _slideshow_thread
     if _slideshow_thread is not None and _slideshow_thread.is_alive():
         return
 
-    _slideshow_thread = threading.Thread(target=_background_slideshow)
+    _slideshow_thread = threading.Thread(target=_background_slideshow, name="slideshow")
     _slideshow_thread.start()
 
 def start() -> None:
-    """Starts the slideshow"""
+    """Starts the slideshow, it will be started on wake up if sleeping"""
     global _slideshow_active
+    if power.is_asleep():
+        return
     _slideshow_active = True
     init()
     logger.info("Slideshow started")
@@ -51,18 +78,40 @@ def _background_slideshow() -> None:
     """Works in a loop while active"""
     global _slideshow_active, _current_album_paths
     logger.info("Started slideshow background routine")
+    shown = collections.deque()
+    prev_end = None
+    path = None
+    skipped = set()
     while _slideshow_active:
-        if not _current_album_paths:
-            make_paths_random()
-        path = list(_album_paths)[_current_album_paths.pop()]
+        path = next_path(path, skipped)
+        if album.is_duplicate(path):
+            # The same content is shown under its canonical path
+            skipped.add(path)
+            continue
+        if path.endswith(tuple(interface.SUPPORTED_VIDEOS)) and power.skip_video():
+            # Video decoding heats the SoC, showing still images instead
+            skipped.add(path)
+            continue
+        skipped.clear()
+
+        now = time.monotonic()
+        if prev_end is not None:
+            metrics.histogram("slideshow_transition_gap_seconds").observe(now - prev_end)
+        shown.append(now)
+        while shown[0] < now - 3600:
+            shown.popleft()
+        metrics.gauge("slideshow_items_per_hour").set(len(shown))
+        metrics.counter("slideshow_items_total").inc()
+
         if path.endswith(tuple(interface.SUPPORTED_IMAGES)):
-            interface.show_image(path, settings.get("slideshow", {}).get("image_display_time", 15), True)
+            interface.show_image(path, power.display_time(settings.get("slideshow", {}).get("image_display_time", 15)), True)
         elif path.endswith(tuple(interface.SUPPORTED_VIDEOS)):
             wait_sec = settings.get("slideshow", {}).get("video_display_time", 30)
             volume = settings.get("slideshow", {}).get("video_volume", 0)
             interface.show_video(path, wait_sec, volume)
         else:
-            log.error("Unable to find the supported format for %s", path)
+            logger.error("Unable to find the supported format for %s", path)
+        prev_end = time.monotonic()
 
     logger.info("Slideshow background routine completed")
 
@@ -74,6 +123,7 @@ def scan() -> None:
     global _watcher, _watcher_thread, _album_paths
 
     logger.info("Start scanning")
+    start = time.monotonic()
 
     dirs = settings.get("slideshow", {}).get("directories")
     supported_exts = tuple( "." + s for s in interface.SUPPORTED_IMAGES.union(interface.SUPPORTED_VIDEOS) )
@@ -96,18 +146,25 @@ def scan() -> None:
                 if change_enum == fsnotify.Change.added:
                     _album_paths.add(change_path)
                     _current_album_paths.append(len(_album_paths))
+                    album.queue_hash(change_path)
+                    metadata.queue_extract(change_path)
                     logger.info('Added file: %s', change_path)
                 elif change_enum == fsnotify.Change.deleted:
                     _current_album_paths.remove(len(_album_paths))
                     _album_paths.remove(change_path)
+                    album.forget(change_path)
+                    metadata.forget(change_path)
                     logger.info('Deleted file: %s', change_path)
 
-        _watcher_thread = threading.Thread(target=start_watching)
+        _watcher_thread = threading.Thread(target=start_watching, name="watcher")
         _watcher_thread.daemon = True
         _watcher_thread.start()
 
         atexit.register(_watcher.dispose)
 
+    album.init()
+    metadata.init()
+
     # Locate the supported files in the album directories
     for directory in dirs:
         logger.info("Processing album directory %s", directory)
@@ -117,6 +174,13 @@ def scan() -> None:
                     continue
                 path = os.path.join(root, filename)
                 _album_paths.add(path)
+                album.queue_hash(path)
+                metadata.queue_extract(path)
         logger.info("Files in the list: %d", len(_album_paths))
+    album.prune(_album_paths)
+    metadata.prune(_album_paths)
+
+    metrics.histogram("slideshow_scan_seconds").observe(time.monotonic() - start)
+    metrics.gauge("slideshow_album_files").set(len(_album_paths))
 
 scan()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import time
+import shutil
+import hashlib
+import logging
+import threading
+import collections
+import urllib.request
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import youtube_dl
+
+logger = logging.getLogger(__name__)
+
+import interface
+import settings
+import metrics
+
+# Download block size
+CHUNK_SIZE = 64 * 1024
+# How long the resolved media URLs are valid
+MANIFEST_TTL = 3600
+MANIFEST_CACHE_SIZE = 32
+# Requests that far ahead of the download are proxied to the origin directly
+# (MP4 files with index at the end for example)
+PROXY_AHEAD = 4 * 1024 * 1024
+
+VIDEO_CODECS = ("avc1", "h264")
+AUDIO_CODECS = ("mp4a", "aac", "mp3", "none")
+PROTOCOLS = ("http", "https")
+
+_manifests = collections.OrderedDict()
+_manifests_lock = threading.Lock()
+_buffers = {}
+# Playbacks waiting for the player to read the first data
+_served = {}
+_server = None
+_server_lock = threading.Lock()
+
+def _config() -> dict:
+    return settings.get("stream", {})
+
+def cache_directory() -> str:
+    return _config().get("cache_directory", "stream_cache")
+
+def _compatible(fmt: dict) -> bool:
+    """Format could be played by omxplayer from the single http URL"""
+    if not fmt.get("url") or fmt.get("protocol", "https") not in PROTOCOLS:
+        return False
+    vcodec = fmt.get("vcodec") or ""
+    acodec = fmt.get("acodec") or ""
+    if vcodec == "none":
+        return False
+    if not vcodec:
+        # Codecs are unknown, so relying on the container
+        return fmt.get("ext") == "mp4"
+    return vcodec.startswith(VIDEO_CODECS) and (not acodec or acodec.startswith(AUDIO_CODECS))
+
+def choose_format(formats: list, screen: dict) -> (dict, None):
+    """Returns the smallest compatible format covering the screen
+
+    If nothing is big enough, the biggest compatible format is used.
+    """
+    playable = [f for f in formats if _compatible(f)]
+    if not playable:
+        return None
+    def area(f: dict) -> int:
+        return (f.get("width") or 0) * (f.get("height") or 0)
+    screen_short = min(screen["width"], screen["height"])
+    covering = [f for f in playable if min(f.get("width") or 0, f.get("height") or 0) >= screen_short]
+    if covering:
+        return min(covering, key=lambda f: (area(f), f.get("tbr") or 0))
+    return max(playable, key=lambda f: (area(f), f.get("tbr") or 0))
+
+def resolve(url: str) -> dict:
+    """Resolves the page URL to the media format, cached for MANIFEST_TTL"""
+    now = time.monotonic()
+    with _manifests_lock:
+        cached = _manifests.get(url)
+        if cached is not None and now - cached[0] < MANIFEST_TTL:
+            _manifests.move_to_end(url)
+            metrics.counter("stream_manifest_cache_total", result="hit").inc()
+            return cached[1]
+    metrics.counter("stream_manifest_cache_total", result="miss").inc()
+
+    with metrics.timed("stream_resolve_seconds"):
+        with youtube_dl.YoutubeDL({"quiet": True, "noplaylist": True, "skip_download": True}) as ydl:
+            info = ydl.extract_info(url, download=False)
+    if "entries" in info:
+        info = next(iter(info["entries"]))
+    fmt = choose_format(info.get("formats") or [info], interface.screen_size())
+    if fmt is None:
+        raise Exception("Unable to find the format supported by the player")
+
+    media = {
+        "key": hashlib.sha1((url + "|" + str(fmt.get("format_id"))).encode()).hexdigest(),
+        "url": fmt["url"],
+        "headers": fmt.get("http_headers") or {},
+        "title": info.get("title", url),
+        "width": fmt.get("width"),
+        "height": fmt.get("height"),
+    }
+    with _manifests_lock:
+        _manifests[url] = (now, media)
+        while len(_manifests) > MANIFEST_CACHE_SIZE:
+            _manifests.popitem(last=False)
+    return media
+
+def _enforce_budget(keep: str) -> None:
+    """Removes the least recently played files over the cache byte budget"""
+    budget = _config().get("cache_bytes", 512 * 1024 * 1024)
+    directory = cache_directory()
+    files = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(".part") or path == keep:
+            continue
+        stat = os.stat(path)
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(f[1] for f in files) + os.path.getsize(keep)
+    for _, size, path in sorted(files):
+        if total <= budget:
+            break
+        logger.info("Removing cached stream %s", path)
+        os.unlink(path)
+        total -= size
+
+class StreamBuffer:
+    """Downloads the media to the cache file, readers could follow the download"""
+
+    def __init__(self, key: str, url: str, headers: dict):
+        self.key = key
+        self.url = url
+        self.headers = headers
+        self.path = os.path.join(cache_directory(), key + ".part")
+        self.size = None
+        self.written = 0
+        self.done = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def start(self) -> None:
+        os.makedirs(cache_directory(), exist_ok=True)
+        thread = threading.Thread(target=self._download, name="stream")
+        thread.daemon = True
+        thread.start()
+
+    def _download(self) -> None:
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url, headers=self.headers), timeout=30) as resp, \
+                    open(self.path, "wb") as fd:
+                length = resp.headers.get("Content-Length")
+                self.size = int(length) if length else None
+                while True:
+                    chunk = resp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    fd.write(chunk)
+                    fd.flush()
+                    with self._cond:
+                        self.written += len(chunk)
+                        self._cond.notify_all()
+            final = os.path.join(cache_directory(), self.key)
+            os.replace(self.path, final)
+            with self._cond:
+                self.path = final
+            _enforce_budget(final)
+            metrics.counter("stream_download_bytes_total").inc(self.written)
+            logger.info("Stream %s downloaded: %d bytes in %.1fs", self.key, self.written, time.monotonic() - start)
+        except Exception as e:
+            logger.error("Stream %s download failed: %s", self.key, e)
+            self.error = e
+            if self.path.endswith(".part") and os.path.exists(self.path):
+                os.unlink(self.path)
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+            _buffers.pop(self.key, None)
+
+    def wait(self, offset: int, timeout: float = None) -> bool:
+        """Waits until the data at offset is downloaded, False if it never will"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.written > offset or self.done, timeout)
+            return self.written > offset
+
+    def open(self):
+        with self._cond:
+            return open(self.path, "rb")
+
+class _StreamHandler(BaseHTTPRequestHandler):
+    """Serves the growing cache file to the local player with Range support"""
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _range(self) -> int:
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        return int(match.group(1)) if match else 0
+
+    def _headers(self, offset: int, size: (int, None)) -> None:
+        self.send_response(206 if offset else 200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Accept-Ranges", "bytes")
+        if size is not None:
+            self.send_header("Content-Length", str(size - offset))
+            if offset:
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (offset, size - 1, size))
+        self.end_headers()
+
+    def _proxy(self, buf: StreamBuffer, offset: int) -> None:
+        """Passes the range request to the origin"""
+        headers = dict(buf.headers, Range="bytes=%d-" % offset)
+        with urllib.request.urlopen(urllib.request.Request(buf.url, headers=headers), timeout=30) as resp:
+            self._headers(offset, buf.size)
+            shutil.copyfileobj(resp, self.wfile, CHUNK_SIZE)
+
+    def do_GET(self):
+        key = self.path.strip("/")
+        offset = self._range()
+        buf = _buffers.get(key)
+        try:
+            if buf is None:
+                path = os.path.join(cache_directory(), key)
+                if "/" in key or not os.path.isfile(path):
+                    self.send_error(404)
+                    return
+                with open(path, "rb") as fd:
+                    self._headers(offset, os.fstat(fd.fileno()).st_size)
+                    fd.seek(offset)
+                    self.wfile.write(fd.read(CHUNK_SIZE))
+                    _mark_served(key)
+                    shutil.copyfileobj(fd, self.wfile, CHUNK_SIZE)
+                return
+
+            if buf.size is not None and offset > buf.written + PROXY_AHEAD:
+                self._proxy(buf, offset)
+                return
+
+            if buf.size is None:
+                # The length is unknown, so no valid Content-Range: ignore the
+                # Range and send the whole content with 200 as HTTP allows
+                offset = 0
+            if not buf.wait(offset, 30):
+                self.send_error(416 if buf.error is None else 502)
+                return
+            self._headers(offset, buf.size)
+            with buf.open() as fd:
+                fd.seek(offset)
+                while buf.wait(offset, 30):
+                    chunk = fd.read(min(CHUNK_SIZE, buf.written - offset))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    _mark_served(key)
+                    offset += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # The player closes the connection on seek or exit
+            pass
+
+def _mark_served(key: str) -> None:
+    served = _served.pop(key, None)
+    if served is not None:
+        served.set()
+
+def _server_url(key: str) -> str:
+    """Starts the local stream server if needed and returns the URL for key"""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("127.0.0.1", 0), _StreamHandler)
+            _server.daemon_threads = True
+            thread = threading.Thread(target=_server.serve_forever, name="stream_server")
+            thread.daemon = True
+            thread.start()
+    return "http://127.0.0.1:%d/%s" % (_server.server_address[1], key)
+
+def play(url: str) -> tuple:
+    """Starts the URL playback, returns (player process, media, time to first frame)
+
+    Playback starts as soon as the buffer is filled, the rest is downloaded
+    to the cache while playing. Cached media is served by the same local
+    server, so time to first frame is measured up to the moment the player
+    gets the first data in both cases.
+    """
+    start = time.monotonic()
+    media = resolve(url)
+    key = media["key"]
+
+    cached = os.path.join(cache_directory(), key)
+    if os.path.isfile(cached):
+        result = "hit"
+        # Mark as recently played for the cache budget
+        os.utime(cached)
+    else:
+        result = "miss"
+        buf = _buffers.get(key)
+        if buf is None:
+            buf = StreamBuffer(key, media["url"], media["headers"])
+            _buffers[key] = buf
+            buf.start()
+        buf.wait(_config().get("buffer_bytes", 1024 * 1024) - 1, 30)
+        if buf.error is not None and buf.written == 0:
+            raise Exception("Unable to download the stream: %s" % buf.error)
+
+    # The download could finish before the player connects, so the data is
+    # served either from the buffer or from the cache file
+    served = threading.Event()
+    _served[key] = served
+    proc = interface.show_video(_server_url(key))
+    served.wait(30)
+    _served.pop(key, None)
+    ttff = time.monotonic() - start
+
+    metrics.counter("stream_cache_total", result=result).inc()
+    metrics.histogram("stream_time_to_first_frame_seconds", cache=result).observe(ttff)
+    logger.info("Playing %s (cache %s), time to first frame %.2fs", url, result, ttff)
+    return proc, media, ttff
@@ -1,8 +1,10 @@
  #!/usr/bin/env python3
 
 import os, sys
+import math
 import signal
 import logging
+import threading
 import tempfile
 import subprocess
 import html
@@ -10,8 +12,15 @@ import traceback
 import json
 
 import settings
-
-from telegram import Update, ForceReply, PhotoSize, ParseMode
+import logs
+import metrics
+import profiler
+import album
+import stream
+import power
+import fleet
+
+from telegram import Update, ForceReply, PhotoSize, ParseMode, MessageEntity
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
 
 import RPi.GPIO as GPIO
@@ -28,12 +37,28 @@ import slideshow
 import time
 from datetime import datetime
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
-)
+logs.setup()
 
 logger = logging.getLogger("teleglobe")
 
+def measured(name: str, callback):
+    """Wraps the handler callback to record its latency"""
+    def wrapper(update: Update, context: CallbackContext) -> None:
+        with metrics.timed("handler_seconds", handler=name):
+            return callback(update, context)
+    return wrapper
+
+def download(f, out, kind: str) -> None:
+    """Downloads telegram file and records the download speed"""
+    start = time.monotonic()
+    f.download(out=out)
+    duration = time.monotonic() - start
+    size = out.tell()
+    metrics.counter("download_bytes_total", kind=kind).inc(size)
+    metrics.histogram("download_seconds", kind=kind).observe(duration)
+    if duration > 0:
+        metrics.gauge("download_bytes_per_second", kind=kind).set(size / duration)
+
 def tg_error_handler(update: object, context: CallbackContext) -> None:
     """Log the error and send a telegram message to notify the developer."""
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -81,8 +106,12 @@ def tg_help(update: Update, context: CallbackContext) -> None:
         "  /exec_command - execute command in shell and get outputs\n"
         "  /volume - get or set audio master volume ('' - get, '0'-'100' - set)\n"
         "  /settings - get or set settings ('' - all, '<KEY>' - for key, '<KEY> <JSON> - set key value')\n"
+        "  /profile - sample all the threads stacks for '<SECONDS>' and send collapsed stacks file\n"
+        "  /stats - get the performance metrics summary\n"
+        "  /logs - get recent log records ('[LEVEL] [N]', default 'INFO 20')\n"
         "\n\n"
         "Also you can send photo, video and audio to show it on the globe.\n"
+        "Video links are streamed to the globe display.\n"
         "To update teleglobe - send zip archive with new distributive."
     )
 
@@ -97,6 +126,36 @@ def tg_echo(update: Update, context: CallbackContext) -> None:
     update.message.reply_text(update.message.text)
 
 
+def tg_link(update: Update, context: CallbackContext) -> None:
+    """Stream the video from the link on the display."""
+
+    if update.message.from_user.username not in settings.get("users", []):
+        update.message.reply_text("ERROR: Access denied")
+        return
+
+    power.wake()
+
+    entities = update.message.parse_entities([MessageEntity.URL, MessageEntity.TEXT_LINK])
+    entity, text = next(iter(entities.items()))
+    url = entity.url if entity.type == MessageEntity.TEXT_LINK else text
+
+    update.message.reply_text("Resolving link...")
+    with power.awake():
+        slideshow.stop()
+        interface.show_black()
+        try:
+            proc, media, ttff = stream.play(url)
+        except Exception as e:
+            update.message.reply_text("ERROR: Unable to play the link: {0}".format(e))
+            proc = None
+        else:
+            update.message.reply_text("Show video {0} ({1}x{2}), started in {3:.1f}s".format(media["title"], media["width"], media["height"], ttff))
+            proc.communicate()
+    if proc is not None:
+        update.message.reply_text("Ok, video showed")
+    slideshow.start()
+
+
 def tg_media_photo(update: Update, context: CallbackContext) -> None:
     """Show photo on the display."""
 
@@ -104,6 +163,8 @@ def tg_media_photo(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("ERROR: Access denied")
         return
 
+    power.wake()
+
     if not update.message.photo:
         update.message.reply_text("ERROR: Unable to find photo in the message")
         return
@@ -125,16 +186,20 @@ def tg_media_photo(update: Update, context: CallbackContext) -> None:
         return
 
     f = best_image.get_file()
-    with tempfile.NamedTemporaryFile(suffix="file.jpg") as tf:
+    with album.tempfile_for("file.jpg") as tf:
         update.message.reply_text("Downloading photo {0}...".format(f.file_size))
-        f.download(out=tf)
+        download(f, tf, "photo")
         tf.flush()
+        path = album.store(tf.name, "jpg") or tf.name
+        at = fleet.publish("photo", path, 60)
 
-        slideshow.stop()
-        interface.show_black()
+        with power.awake():
+            slideshow.stop()
+            interface.show_black()
+            fleet.wait_until(at)
 
-        update.message.reply_text("Show photo for 60 sec")
-        proc = interface.show_image(tf.name, 60)
+            update.message.reply_text("Show photo for 60 sec")
+            proc = interface.show_image(path, 60)
 
     slideshow.start()
     update.message.reply_text("Photo show done")
@@ -154,7 +219,7 @@ def tg_media_audio(update: Update, context: CallbackContext) -> None:
     f = audio.get_file()
     with tempfile.NamedTemporaryFile(suffix="file.mp3") as tf:
         update.message.reply_text("Downloading audio {0}...".format(audio.file_size))
-        f.download(out=tf)
+        download(f, tf, "audio")
         tf.flush()
 
         update.message.reply_text("Play audio: {}s".format(audio.duration))
@@ -170,6 +235,8 @@ def tg_media_video(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("ERROR: Access denied")
         return
 
+    power.wake()
+
     if update.message.video_note:
         video = update.message.video_note
     elif update.message.video:
@@ -179,17 +246,21 @@ def tg_media_video(update: Update, context: CallbackContext) -> None:
         return
 
     f = video.get_file()
-    with tempfile.NamedTemporaryFile(suffix="file.mp4") as tf:
+    with album.tempfile_for("file.mp4") as tf:
         update.message.reply_text("Downloading video {0}...".format(video.file_size))
-        f.download(out=tf)
+        download(f, tf, "video")
         tf.flush()
+        path = album.store(tf.name, "mp4") or tf.name
+        at = fleet.publish("video", path, video.duration)
 
-        slideshow.stop()
-        interface.show_black()
+        with power.awake():
+            slideshow.stop()
+            interface.show_black()
+            fleet.wait_until(at)
 
-        update.message.reply_text("Show video: {}s".format(video.duration))
-        proc = interface.show_video(tf.name)
-        proc.communicate()
+            update.message.reply_text("Show video: {}s".format(video.duration))
+            proc = interface.show_video(path)
+            proc.communicate()
     update.message.reply_text("Ok, video showed")
     slideshow.start()
 
@@ -210,7 +281,7 @@ def tg_update_archive(update: Update, context: CallbackContext) -> None:
 
     f = update.message.document.get_file()
     with open("update.zip", "wb") as tf:
-        f.download(out=tf)
+        download(f, tf, "update")
         tf.flush()
 
     update.message.reply_text("Ok, restarting and updating teleglobe")
@@ -291,10 +362,123 @@ def tg_settings(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("Settings: {0}".format(json.dumps(settings.all())))
 
 
+def tg_logs(update: Update, context: CallbackContext) -> None:
+    """Show the recent log records from memory (as "[LEVEL] [N]")"""
+
+    if update.message.from_user.username not in settings.get("admins", []):
+        update.message.reply_text("ERROR: Access denied")
+        return
+
+    level, count = logging.INFO, 20
+    for arg in update.message.text.split()[1:]:
+        if arg.isdigit():
+            count = int(arg)
+        elif isinstance(logging.getLevelName(arg.upper()), int):
+            level = logging.getLevelName(arg.upper())
+        else:
+            update.message.reply_text("ERROR: Unknown argument {0}".format(arg))
+            return
+
+    # Telegram message is limited to 4096 chars, so showing the latest ones
+    lines = logs.recent(level, count, 4000)
+    if not lines:
+        update.message.reply_text("No log records found")
+        return
+    update.message.reply_text("\n".join(lines))
+
+
+def tg_stats(update: Update, context: CallbackContext) -> None:
+    """Show the metrics summary"""
+
+    if update.message.from_user.username not in settings.get("admins", []):
+        update.message.reply_text("ERROR: Access denied")
+        return
+
+    update.message.reply_text(metrics.summary()[-4000:] or "No metrics collected yet")
+
+
+def tg_profile(update: Update, context: CallbackContext) -> None:
+    """Sample the threads stacks and send flamegraph-ready collapsed stacks"""
+
+    if update.message.from_user.username not in settings.get("admins", []):
+        update.message.reply_text("ERROR: Access denied")
+        return
+
+    try:
+        seconds = float(update.message.text.split(' ', 1)[1])
+        if not math.isfinite(seconds) or seconds <= 0:
+            raise ValueError(seconds)
+    except (IndexError, ValueError):
+        update.message.reply_text("ERROR: Please specify the profiling duration in seconds")
+        return
+
+    update.message.reply_text("Profiling for {0}s...".format(min(seconds, profiler.MAX_DURATION)))
+    result = profiler.sample(seconds)
+    if result is None:
+        update.message.reply_text("ERROR: Profiling is already in progress")
+        return
+
+    stacks, stats = result
+    if not stacks:
+        update.message.reply_text("ERROR: No samples collected ({})".format(stats))
+        return
+    update.message.reply_document(
+        document=stacks.encode(),
+        filename="profile-{}.collapsed".format(datetime.now().strftime('%y%m%d%H%M%S')),
+        caption=stats,
+    )
+
+
 # TODO: Take photo from camera
 #  raspistill --nopreview -roi 0,0,0.6,1 -o out.jpg
 
 
+def display_on() -> None:
+    """Turn on the display and continue the slideshow"""
+    GPIO.output(18, settings.get("power", {}).get("display_on_level", GPIO.LOW))
+    slideshow.start()
+
+def display_off() -> None:
+    """Stop the slideshow and turn off the display"""
+    slideshow.stop()
+    interface.cleanup_display()
+    interface.show_black()
+    GPIO.output(18, GPIO.LOW if settings.get("power", {}).get("display_on_level", GPIO.LOW) else GPIO.HIGH)
+
+def fleet_show(kind: str, path: str, duration: float) -> None:
+    """Show the media commanded by the fleet leader"""
+    with power.awake():
+        slideshow.stop()
+        interface.show_black()
+        if kind == "photo":
+            interface.show_image(path, duration or 60)
+        else:
+            interface.show_video(path).communicate()
+    slideshow.start()
+
+def runFleetFollower() -> None:
+    """Get the media and display commands from the fleet leader instead of Telegram"""
+    fleet.init_follower(fleet_show)
+
+    logger.info("Running Slideshow")
+    slideshow.scan()
+    slideshow.start()
+
+    power.init(display_off, display_on)
+
+    # Return from main on the stop signals, so the atexit cleanups are executed
+    stopped = threading.Event()
+    def stop(signum, frame):
+        logger.info("Received signal %d, stopping", signum)
+        stopped.set()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, stop)
+
+    logger.info("Entering IDLE loop")
+    stopped.wait()
+    # The slideshow thread would block the interpreter exit
+    slideshow.stop()
+
 def checkInternet() -> bool:
     """Make sure internet is here"""
     return checkTCPConnection("google.com", 443)
@@ -319,33 +503,51 @@ def main() -> None:
 
     interface.show_welcome()
 
+    if fleet.role() == "follower":
+        logger.info("Running as fleet follower")
+        runFleetFollower()
+        return
+
     logger.info("Init telegram bot listener")
     updater = Updater(settings.get("telegram", {}).get("api_token"))
 
     dispatcher = updater.dispatcher
     dispatcher.add_error_handler(tg_error_handler)
 
-    dispatcher.add_handler(CommandHandler("start", tg_start))
-    dispatcher.add_handler(CommandHandler("mixer", tg_mixer))
-    dispatcher.add_handler(CommandHandler("exec_command", tg_exec_command))
-    dispatcher.add_handler(CommandHandler("volume", tg_volume))
-    dispatcher.add_handler(CommandHandler("settings", tg_settings))
-    dispatcher.add_handler(CommandHandler("help", tg_help))
+    dispatcher.add_handler(CommandHandler("start", measured("start", tg_start)))
+    dispatcher.add_handler(CommandHandler("mixer", measured("mixer", tg_mixer)))
+    dispatcher.add_handler(CommandHandler("exec_command", measured("exec_command", tg_exec_command)))
+    dispatcher.add_handler(CommandHandler("volume", measured("volume", tg_volume)))
+    dispatcher.add_handler(CommandHandler("settings", measured("settings", tg_settings)))
+    dispatcher.add_handler(CommandHandler("profile", measured("profile", tg_profile), run_async=True))
+    dispatcher.add_handler(CommandHandler("stats", measured("stats", tg_stats)))
+    dispatcher.add_handler(CommandHandler("logs", measured("logs", tg_logs)))
+    dispatcher.add_handler(CommandHandler("help", measured("help", tg_help)))
 
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, tg_echo))
+    dispatcher.add_handler(MessageHandler((Filters.entity(MessageEntity.URL) | Filters.entity(MessageEntity.TEXT_LINK)) & ~Filters.command, measured("link", tg_link)))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, measured("echo", tg_echo)))
 
     # Media handlers
-    dispatcher.add_handler(MessageHandler(Filters.photo, tg_media_photo))
-    dispatcher.add_handler(MessageHandler(Filters.audio, tg_media_audio))
-    dispatcher.add_handler(MessageHandler(Filters.video | Filters.video_note, tg_media_video))
-    dispatcher.add_handler(MessageHandler(Filters.document.file_extension("zip"), tg_update_archive))
+    dispatcher.add_handler(MessageHandler(Filters.photo, measured("media_photo", tg_media_photo)))
+    dispatcher.add_handler(MessageHandler(Filters.audio, measured("media_audio", tg_media_audio)))
+    dispatcher.add_handler(MessageHandler(Filters.video | Filters.video_note, measured("media_video", tg_media_video)))
+    dispatcher.add_handler(MessageHandler(Filters.document.file_extension("zip"), measured("update_archive", tg_update_archive)))
+
+    if fleet.role() == "leader":
+        logger.info("Running as fleet leader")
+        fleet.init_leader()
 
     updater.start_polling()
 
+    if settings.get("metrics", {}).get("textfile"):
+        metrics.start_exporter(settings.get("metrics")["textfile"], settings.get("metrics").get("interval", 60))
+
     logger.info("Running Slideshow")
     slideshow.scan()
     slideshow.start()
 
+    power.init(display_off, display_on)
+
     if os.path.isfile("backup.tar.gz"):
         # Update passed well, so moving the backup aside for future needs
         mod_ts = os.path.getmtime("backup.tar.gz")
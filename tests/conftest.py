@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# The modules read settings.yaml from the working directory on import
+_workdir = tempfile.mkdtemp(prefix="teleglobe-tests-")
+with open(os.path.join(_workdir, "settings.yaml"), "w") as fd:
+    fd.write("{}\n")
+os.chdir(_workdir)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
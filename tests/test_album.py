@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+import settings
+import album
+import fleet
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    directory = tmp_path / "store"
+    monkeypatch.setitem(settings._settings, "album", {"store_directory": str(directory), "index": str(tmp_path / "index.json")})
+    monkeypatch.setattr(album, "_by_hash", {})
+    monkeypatch.setattr(album, "_by_path", {})
+    monkeypatch.setattr(album, "_dirty", 0)
+    return directory
+
+
+def _received(content: bytes) -> str:
+    """Temp file as the Telegram handlers download it"""
+    tf = album.tempfile_for("file.jpg")
+    tf.write(content)
+    tf.flush()
+    return tf
+
+
+def test_store_same_content_twice(store):
+    with _received(b"photo" * 1000) as first:
+        stored = album.store(first.name, "jpg")
+        # Hardlinked on the same filesystem, no copy
+        assert os.stat(stored).st_ino == os.stat(first.name).st_ino
+    with _received(b"photo" * 1000) as second:
+        assert album.store(second.name, "jpg") == stored
+
+    assert os.listdir(store) == [os.path.basename(stored)]
+    assert os.path.basename(stored) == album.file_hash(stored) + ".jpg"
+    assert album.known_hash(stored) == album.file_hash(stored)
+    assert album.store_directory() == str(store)
+
+
+def test_store_disabled(store, monkeypatch, tmp_path):
+    monkeypatch.setitem(settings._settings, "album", {})
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(b"x")
+    assert album.store(str(path), "jpg") is None
+
+
+def test_duplicates_and_prune(store, tmp_path):
+    paths = []
+    for name in ("b.jpg", "a.jpg", "c.jpg"):
+        path = tmp_path / name
+        path.write_bytes(b"other" if name == "c.jpg" else b"same")
+        album._process(str(path))
+        paths.append(str(path))
+    b, a, c = paths
+
+    # The lowest path is the canonical one
+    assert album.is_duplicate(b)
+    assert not album.is_duplicate(a)
+    assert not album.is_duplicate(c)
+    assert album.duplicates() == {album.file_hash(a): [a, b]}
+
+    album.prune({b, c})
+    assert not album.is_duplicate(b)
+    assert album.duplicates() == {}
+
+    # Modified file is not trusted anymore
+    with open(c, "ab") as fd:
+        fd.write(b"!")
+    assert album.known_hash(c) is None
+
+
+def test_link_file_fallbacks(tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.write_bytes(os.urandom(album.CHUNK_SIZE + 100))
+
+    def no_link(src, dst):
+        raise OSError("cross-device link")
+    monkeypatch.setattr(album.os, "link", no_link)
+
+    cloned = []
+    def ficlone(fd, request, arg):
+        assert request == album.FICLONE
+        cloned.append(arg)
+        raise OSError("not supported")
+    monkeypatch.setattr(album.fcntl, "ioctl", ficlone)
+
+    album.link_file(str(src), str(tmp_path / "dst"))
+    assert cloned
+    assert (tmp_path / "dst").read_bytes() == src.read_bytes()
+
+
+def test_publish_reuses_the_stored_hash(store, tmp_path, monkeypatch):
+    with _received(b"video" * 1000) as received:
+        stored = album.store(received.name, "mp4")
+
+    hashed = []
+    file_hash = album.file_hash
+    monkeypatch.setattr(album, "file_hash", lambda path: hashed.append(path) or file_hash(path))
+    leader = fleet.Leader(("127.0.0.1", 0), str(tmp_path / "fleet"), "secret")
+    try:
+        leader.publish("video", stored, 10, delay=0)
+    finally:
+        leader._server.server_close()
+    assert hashed == []
+    assert leader.events(0, 0)["events"][0]["id"] == os.path.basename(stored)[:-4]
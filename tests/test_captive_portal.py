@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import logging
+
+import pytest
+
+import captive_portal
+
+
+def _stub(code: str) -> list:
+    return [sys.executable, "-c", code]
+
+
+@pytest.fixture(params=["pidfd", "poll"])
+def supervisor_cls(request, monkeypatch):
+    monkeypatch.setattr(captive_portal.Supervisor, "BACKOFF_MIN", 0.1)
+    monkeypatch.setattr(captive_portal.Supervisor, "POLL_INTERVAL", 0.1)
+    if request.param == "poll":
+        def no_pidfd(pid):
+            raise AttributeError("pidfd_open")
+        monkeypatch.setattr(captive_portal.os, "pidfd_open", no_pidfd, raising=False)
+    return captive_portal.Supervisor
+
+
+def test_chatty_daemon_is_streamed(supervisor_cls, caplog):
+    caplog.set_level(logging.INFO, logger="captive_portal")
+    supervisor = supervisor_cls(lambda daemon: False)
+    # Far more than the pipe buffer, would block if not drained
+    supervisor.add("chatty", _stub("for i in range(20000): print('line', i)"))
+    supervisor.run()
+    supervisor.shutdown()
+
+    lines = [r.getMessage() for r in caplog.records if r.getMessage().startswith("chatty: line")]
+    assert len(lines) == 20000
+    assert lines[-1] == "chatty: line 19999"
+
+
+def test_crash_restarts_with_backoff(supervisor_cls):
+    starts = []
+    def on_exit(daemon):
+        starts.append(time.monotonic())
+        return len(starts) < 4
+    supervisor = supervisor_cls(on_exit)
+    daemon = supervisor.add("crashy", _stub("import sys; sys.exit(3)"))
+    supervisor.run()
+    supervisor.shutdown()
+
+    assert daemon.returncode == 3
+    assert daemon.restarts == 3
+    gaps = [b - a for a, b in zip(starts, starts[1:])]
+    # 0.1, 0.2, 0.4 seconds backoff between the restarts
+    assert gaps[1] > gaps[0] and gaps[2] > gaps[1]
+
+
+def test_clean_exit_stops_and_shutdown_terminates(supervisor_cls):
+    exited = []
+    def on_exit(daemon):
+        exited.append((daemon.name, daemon.returncode))
+        return not (daemon.name == "captive_portal" and daemon.returncode == 0)
+    supervisor = supervisor_cls(on_exit)
+    sleeper = supervisor.add("hostapd", _stub("import time; time.sleep(60)"))
+    supervisor.add("captive_portal", _stub("import time; time.sleep(0.3)"))
+    supervisor.run()
+
+    assert exited == [("captive_portal", 0)]
+    assert sleeper.running()
+    supervisor.shutdown()
+    assert not sleeper.running()
+
+
+def test_all_stopped_without_restart(supervisor_cls):
+    supervisor = supervisor_cls()
+    supervisor.add("once", _stub("pass"), restart=False)
+    with pytest.raises(Exception, match="All the apps stopped"):
+        supervisor.run()
+    supervisor.shutdown()
+
+
+def _alive(pid: int) -> bool:
+    try:
+        with open("/proc/%d/stat" % pid) as fd:
+            # Killed child could stay a zombie if nobody reaps it
+            return fd.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_shutdown_kills_the_wrapped_daemon(monkeypatch):
+    # Run the kill command without sudo
+    monkeypatch.setattr(captive_portal, "_exec_wait", lambda cmd: captive_portal.subprocess.run(cmd[1:] if cmd[0] == "sudo" else cmd))
+    supervisor = captive_portal.Supervisor()
+    # Wrapper ignores SIGTERM like sudo would not relay it, the child is the real daemon
+    wrapper = _stub(
+        "import signal, subprocess, sys; signal.signal(signal.SIGTERM, signal.SIG_IGN); "
+        "p = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)']); "
+        "print(p.pid, flush=True); p.wait()")
+    daemon = supervisor.add("hostapd", wrapper)
+    supervisor._start(daemon)
+    deadline = time.monotonic() + 5
+    child = None
+    while child is None and time.monotonic() < deadline:
+        try:
+            child = int(os.read(daemon.proc.stdout.fileno(), 100).split()[0])
+        except (BlockingIOError, IndexError):
+            time.sleep(0.05)
+    assert child is not None and _alive(child)
+
+    supervisor.shutdown(timeout=0.5)
+
+    assert not daemon.running()
+    deadline = time.monotonic() + 5
+    while _alive(child) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not _alive(child)
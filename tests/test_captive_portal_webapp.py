@@ -0,0 +1,125 @@
+import socket
+import threading
+import time
+import http.client
+
+import pytest
+
+import captive_portal_webapp as webapp
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(webapp, "wpaNetworksList", lambda: ["home", "neighbour"])
+    monkeypatch.setattr(webapp.Redirect, "timeout", 2)
+    webapp._refresh_networks()
+    srv = webapp.PortalServer(("127.0.0.1", 0), webapp.Redirect)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv.server_address[1]
+    srv.shutdown()
+    srv.server_close()
+
+
+def _get(port, path, host):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", path, headers={"Host": host})
+    resp = conn.getresponse()
+    return resp.status, resp.read()
+
+
+def test_probes_and_setup_page(server):
+    assert _get(server, "/generate_204", "connectivitycheck.gstatic.com")[0] == 302
+    assert _get(server, "/connecttest.txt", "www.msftconnecttest.com")[0] == 302
+    status, body = _get(server, "/hotspot-detect.html", "captive.apple.com")
+    assert status == 200 and b"setup.teleglobe" in body
+    status, body = _get(server, "/", "setup.teleglobe")
+    assert status == 200 and b"neighbour" in body
+
+
+def test_too_big_post(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=5)
+    conn.request("POST", "/", body=b"x" * (webapp.MAX_BODY_SIZE + 1), headers={
+        "Host": "setup.teleglobe",
+        "Content-Type": "application/x-www-form-urlencoded",
+    })
+    assert b"Too big request" in conn.getresponse().read()
+
+
+def test_burst_with_slow_client(server):
+    # Slow-loris client holds the connection without sending the request
+    slow = socket.create_connection(("127.0.0.1", server))
+    slow.sendall(b"GET / HTTP/1.1\r\n")
+
+    errors = []
+    def client(i):
+        try:
+            for j in range(10):
+                if (i + j) % 3:
+                    assert _get(server, "/generate_204", "clients3.google.com")[0] == 302
+                else:
+                    assert _get(server, "/", "setup.teleglobe")[0] == 200
+        except Exception as e:
+            errors.append(e)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+    slow.close()
+
+    assert not errors
+    # 200 requests must not wait for the slow client read timeout
+    assert elapsed < webapp.Redirect.timeout
+
+
+def test_trickling_client_is_cut_off(server, monkeypatch):
+    monkeypatch.setattr(webapp, "READ_TIMEOUT", 1)
+    trickle = socket.create_connection(("127.0.0.1", server))
+    start = time.monotonic()
+    closed = []
+    def read():
+        try:
+            while trickle.recv(4096):
+                pass
+        except OSError:
+            pass
+        closed.append(time.monotonic() - start)
+    reader = threading.Thread(target=read)
+    reader.start()
+
+    # Every byte comes well within the socket timeout, the request never ends
+    request = b"GET / HTTP/1.1\r\nHost: setup.teleglobe\r\nX-Slow: " + b"x" * 100
+    for byte in request:
+        if closed or time.monotonic() - start > 5:
+            break
+        try:
+            trickle.sendall(bytes((byte,)))
+        except OSError:
+            break
+        time.sleep(0.3)
+    reader.join(5)
+    trickle.close()
+
+    assert closed and closed[0] < webapp.READ_TIMEOUT + 1
+
+
+def test_handlers_are_capped(server, monkeypatch):
+    monkeypatch.setattr(webapp, "MAX_HANDLERS", 4)
+    srv = webapp.PortalServer(("127.0.0.1", 0), webapp.Redirect)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    port = srv.server_address[1]
+    try:
+        idle = [socket.create_connection(("127.0.0.1", port)) for _ in range(6)]
+        time.sleep(0.3)
+        # Only MAX_HANDLERS threads are started, the rest wait in the backlog
+        assert srv._handlers._value == 0
+        for sock in idle:
+            sock.close()
+        assert _get(port, "/generate_204", "clients3.google.com")[0] == 302
+    finally:
+        srv.shutdown()
+        srv.server_close()
@@ -0,0 +1,92 @@
+import os
+import time
+import threading
+
+import pytest
+
+import fleet
+
+
+@pytest.fixture
+def leader(tmp_path):
+    leader = fleet.Leader(("127.0.0.1", 0), str(tmp_path / "leader"), "secret")
+    leader.start()
+    yield leader
+    leader.stop()
+
+
+def _follower(tmp_path, leader, name, show):
+    follower = fleet.Follower("http://127.0.0.1:%d" % leader.address[1], str(tmp_path / name), show, "secret")
+    follower.start()
+    deadline = time.monotonic() + 10
+    while follower._since is None:
+        assert time.monotonic() < deadline, "follower did not connect"
+        time.sleep(0.05)
+    return follower
+
+
+def test_delay_scales_with_size(tmp_path, leader, monkeypatch):
+    monkeypatch.setattr(fleet, "TRANSFER_RATE", 1000)
+    media = tmp_path / "video.mp4"
+    media.write_bytes(b"x" * 5000)
+
+    # Nobody to wait for
+    now = time.monotonic()
+    at = leader.publish("video", str(media), 10)
+    assert at - now == pytest.approx(fleet.SHOW_DELAY, abs=0.5)
+
+    follower = _follower(tmp_path, leader, "f", lambda *args: None)
+    assert leader.followers() == ["127.0.0.1"]
+    now = time.monotonic()
+    at = leader.publish("video", str(media), 10)
+    assert at - now == pytest.approx(fleet.SHOW_DELAY + 5, abs=0.5)
+    follower.stop()
+    assert leader.publish("video", str(media), 10, delay=0.5) - time.monotonic() <= 0.5
+
+
+def test_followers_show_in_sync_without_blocking_the_poll(tmp_path, leader):
+    shown = []
+    lock = threading.Lock()
+    def show(kind, path, duration):
+        with lock:
+            shown.append((time.monotonic(), kind, open(path, "rb").read()))
+        time.sleep(duration)
+
+    followers = [_follower(tmp_path, leader, "f%d" % i, show) for i in range(2)]
+    first, second = tmp_path / "first.mp4", tmp_path / "second.jpg"
+    first.write_bytes(os.urandom(3 * fleet.CHUNK_SIZE + 10))
+    second.write_bytes(os.urandom(1000))
+
+    at = leader.publish("video", str(first), 1.0, delay=1.0)
+    # Published while the first one is shown, the poll must keep going
+    at2 = leader.publish("photo", str(second), 0, delay=1.5)
+
+    deadline = time.monotonic() + 10
+    while len(shown) < 4:
+        assert time.monotonic() < deadline, "not all the shows happened: %s" % shown
+        time.sleep(0.05)
+    for f in followers:
+        f.stop()
+
+    videos = [s for s in shown if s[1] == "video"]
+    photos = [s for s in shown if s[1] == "photo"]
+    assert all(s[2] == first.read_bytes() for s in videos)
+    assert all(s[2] == second.read_bytes() for s in photos)
+    assert abs(videos[0][0] - videos[1][0]) < 0.2
+    assert abs(videos[0][0] - at) < 0.3
+    # Shows do not overlap on the same display: the photo waits for the video
+    assert all(p[0] >= at + 0.9 for p in photos)
+    assert all(p[0] >= at2 for p in photos)
+
+
+def test_token_is_required(tmp_path, monkeypatch):
+    monkeypatch.setitem(fleet.settings._settings, "fleet", {"role": "leader", "listen": "127.0.0.1:0"})
+    with pytest.raises(Exception, match="fleet.token"):
+        fleet.init_leader()
+    with pytest.raises(Exception, match="fleet.token"):
+        fleet.init_follower(lambda *args: None)
+
+    open_leader = fleet.Leader(("127.0.0.1", 0), str(tmp_path / "open"))
+    assert not open_leader.authorized("")
+    assert not open_leader.authorized(None)
+    open_leader._server.server_close()
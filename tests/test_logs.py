@@ -0,0 +1,75 @@
+import logging
+
+import pytest
+
+import logs
+
+
+def _record(name: str, level: int = logging.INFO, msg: str = "message") -> logging.LogRecord:
+    return logging.LogRecord(name, level, __file__, 1, msg, (), None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(logs.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_rate_limit_token_bucket(clock):
+    limiter = logs.RateLimitFilter({"slideshow": 1.0}, burst=3)
+    passed = [limiter.filter(_record("slideshow")) for _ in range(5)]
+    assert passed == [True, True, True, False, False]
+
+    # Warnings are never dropped
+    assert limiter.filter(_record("slideshow", logging.WARNING))
+
+    clock[0] += 1.0
+    record = _record("slideshow", msg="next %s")
+    assert limiter.filter(record)
+    assert record.msg == "(2 suppressed) next %s"
+    # The counter starts over after it is reported
+    clock[0] += 1.0
+    record = _record("slideshow")
+    assert limiter.filter(record)
+    assert record.msg == "message"
+
+
+def test_rate_limit_by_dotted_prefix(clock):
+    limiter = logs.RateLimitFilter({"telegram": 1.0, "telegram.ext.dispatcher": 100.0}, burst=1)
+    assert limiter.filter(_record("telegram.bot"))
+    assert not limiter.filter(_record("telegram.bot"))
+    # Buckets are per logger, the limit comes from the longest matching prefix
+    assert limiter.filter(_record("telegram.vendor"))
+    assert limiter.filter(_record("telegram.ext.dispatcher"))
+    clock[0] += 0.05
+    assert limiter.filter(_record("telegram.ext.dispatcher"))
+    # Similar names are not prefixes
+    assert all(limiter.filter(_record("telegramx")) for _ in range(5))
+
+
+def test_ring_capacity_and_filtering():
+    ring = logs.RingBufferHandler(capacity=5)
+    for i in range(8):
+        ring.emit(_record("test", logging.WARNING if i % 2 else logging.INFO, "line %d" % i))
+
+    assert [r.msg for r in ring.records()] == ["line %d" % i for i in range(3, 8)]
+    assert [r.msg for r in ring.records(logging.WARNING)] == ["line 3", "line 5", "line 7"]
+    assert [r.msg for r in ring.records(logging.WARNING, 2)] == ["line 5", "line 7"]
+    assert [r.msg for r in ring.records(logging.INFO, 1)] == ["line 7"]
+
+
+def test_recent_drops_whole_lines(monkeypatch):
+    ring = logs.RingBufferHandler()
+    monkeypatch.setattr(logs, "_ring", ring)
+    for i in range(10):
+        ring.emit(_record("test", msg="%d" % i * 30))
+
+    lines = logs.recent(count=10)
+    assert len(lines) == 10
+    limit = len(lines[-1]) * 3 + 2
+    trimmed = logs.recent(count=10, max_chars=limit + 5)
+    assert trimmed == lines[-3:]
+    assert len("\n".join(trimmed)) <= limit + 5
+    # The single line over the limit is still shown
+    assert logs.recent(count=10, max_chars=20) == [lines[-1][:20]]
@@ -0,0 +1,147 @@
+import io
+import json
+import time
+import struct
+
+import pytest
+
+import settings
+import metadata
+
+
+def _tiff(endian: str, when: str = "2019:07:14 10:20:30") -> bytes:
+    """IFD0 with orientation and the Exif IFD pointer, Exif IFD with the capture time"""
+    head = (b"II" if endian == "<" else b"MM") + struct.pack(endian + "HL", 42, 8)
+    exif_ifd = 8 + 2 + 2 * 12 + 4
+    when = when.encode() + b"\x00"
+    time_value = exif_ifd + 2 + 3 * 12 + 4
+    ifd0 = struct.pack(endian + "H", 2)
+    ifd0 += struct.pack(endian + "HHLH2x", metadata.TAG_ORIENTATION, 3, 1, 6)
+    ifd0 += struct.pack(endian + "HHLL", metadata.TAG_EXIF_IFD, 4, 1, exif_ifd)
+    ifd0 += struct.pack(endian + "L", 0)
+    exif = struct.pack(endian + "H", 3)
+    exif += struct.pack(endian + "HHLL", metadata.TAG_DATETIME_ORIGINAL, 2, len(when), time_value)
+    exif += struct.pack(endian + "HHLL", metadata.TAG_PIXEL_X, 4, 1, 4000)
+    exif += struct.pack(endian + "HHLL", metadata.TAG_PIXEL_Y, 4, 1, 3000)
+    exif += struct.pack(endian + "L", 0)
+    return head + ifd0 + exif + when
+
+
+def _segment(code: int, payload: bytes) -> bytes:
+    return bytes((0xff, code)) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def _jpeg(*segments: bytes) -> io.BytesIO:
+    return io.BytesIO(b"\xff\xd8" + b"".join(segments) + b"\xff\xda" + b"\x00" * 16)
+
+
+SOF = _segment(0xc0, struct.pack(">BHHB", 8, 480, 640, 3) + b"\x00" * 9)
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_exif_endianness(endian):
+    ret = metadata._parse_tiff(_tiff(endian))
+    assert ret == {
+        "time": time.mktime((2019, 7, 14, 10, 20, 30, 0, 0, -1)),
+        "orientation": 6,
+        "width": 4000,
+        "height": 3000,
+    }
+
+
+def test_jpeg_frame_size_overrides_exif():
+    app0 = _segment(0xe0, b"JFIF\x00" + b"\x00" * 9)
+    ret = metadata.read_jpeg(_jpeg(app0, _segment(0xe1, b"Exif\x00\x00" + _tiff(">")), SOF))
+    assert ret["orientation"] == 6
+    assert ret["time"] == time.mktime((2019, 7, 14, 10, 20, 30, 0, 0, -1))
+    # The frame header is the real size, Exif could be stale after editing
+    assert (ret["width"], ret["height"]) == (640, 480)
+
+
+def test_jpeg_without_exif():
+    assert metadata.read_jpeg(_jpeg(SOF)) == {"width": 640, "height": 480}
+    assert metadata.read_jpeg(io.BytesIO(b"not a jpeg")) == {}
+
+
+def _box(typ: bytes, payload: bytes) -> bytes:
+    return struct.pack(">L4s", len(payload) + 8, typ) + payload
+
+
+def _tkhd(width: int, height: int, matrix: tuple) -> bytes:
+    payload = b"\x00" * 4 + b"\x00" * 20 + b"\x00" * 16 + struct.pack(">9l", *matrix)
+    return _box(b"tkhd", payload + struct.pack(">LL", width << 16, height << 16))
+
+
+def _mp4(created: int) -> bytes:
+    mvhd = _box(b"mvhd", b"\x00" * 4 + struct.pack(">L", created + metadata.MP4_EPOCH_OFFSET) + b"\x00" * 88)
+    identity = (0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    rotated = (0, 0x10000, 0, -0x10000, 0, 0, 0, 0, 0x40000000)
+    audio = _box(b"trak", _tkhd(0, 0, identity))
+    video = _box(b"trak", _tkhd(1920, 1080, rotated))
+    return (_box(b"ftyp", b"isom\x00\x00\x02\x00")
+            + _box(b"mdat", b"\x00" * 4096)
+            + _box(b"moov", mvhd + audio + video))
+
+
+def test_mp4_moov_after_mdat():
+    ret = metadata.read_mp4(io.BytesIO(_mp4(1563099630)))
+    assert ret == {"time": 1563099630.0, "width": 1920, "height": 1080, "orientation": 6}
+
+
+def test_truncated_files(tmp_path):
+    data = _mp4(1563099630)
+    truncated = tmp_path / "video.mp4"
+    truncated.write_bytes(data[:len(data) - 30])
+    record = metadata.extract(str(truncated))
+    # The header is broken, so the capture time is the modification time
+    assert record["time"] == truncated.stat().st_mtime
+
+    jpeg = _jpeg(_segment(0xe1, b"Exif\x00\x00" + _tiff("<")), SOF).getvalue()
+    truncated = tmp_path / "photo.jpg"
+    truncated.write_bytes(jpeg[:30])
+    assert metadata.extract(str(truncated))["time"] == truncated.stat().st_mtime
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    path = tmp_path / "metadata.jsonl"
+    monkeypatch.setitem(settings._settings, "metadata", {"journal": str(path)})
+    monkeypatch.setattr(metadata, "_records", {})
+    monkeypatch.setattr(metadata, "_by_time", [])
+    monkeypatch.setattr(metadata, "_by_day", [])
+    monkeypatch.setattr(metadata, "_journal", None)
+    yield path
+    if metadata._journal is not None:
+        metadata._journal.close()
+
+
+def test_journal_replay_and_compaction(journal):
+    def at(year, month, day):
+        return time.mktime((year, month, day, 12, 0, 0, 0, 0, -1))
+    lines = [
+        {"path": "/a/1.jpg", "size": 1, "mtime": 1, "time": at(2023, 7, 13)},
+        {"path": "/a/2.jpg", "size": 1, "mtime": 1, "time": at(2022, 7, 14)},
+        {"path": "/a/3.jpg", "size": 1, "mtime": 1, "time": at(2024, 7, 11)},
+        {"path": "/a/2.jpg", "deleted": True},
+        {"path": "/a/1.jpg", "size": 2, "mtime": 2, "time": at(2023, 7, 14)},
+    ]
+    journal.write_text("".join(json.dumps(l) + "\n" for l in lines) + '{"path": "/a/partial')
+
+    metadata.load()
+
+    assert sorted(metadata._records) == ["/a/1.jpg", "/a/3.jpg"]
+    assert metadata._records["/a/1.jpg"]["size"] == 2
+    assert [p for _, p in metadata._by_time] == ["/a/1.jpg", "/a/3.jpg"]
+    assert metadata.next_chronological("/a/1.jpg") == "/a/3.jpg"
+    assert metadata.next_chronological("/a/3.jpg") == "/a/1.jpg"
+    assert metadata.next_on_this_day(None, at(2024, 7, 14)) == "/a/1.jpg"
+    # The replaced record does not stay in the day index
+    assert metadata.next_on_this_day(None, at(2024, 7, 13)) is None
+
+    # Compacted to the live records only
+    compacted = [json.loads(l) for l in journal.read_text().splitlines()]
+    assert sorted(r["path"] for r in compacted) == ["/a/1.jpg", "/a/3.jpg"]
+
+    metadata.forget("/a/3.jpg")
+    assert json.loads(journal.read_text().splitlines()[-1]) == {"path": "/a/3.jpg", "deleted": True}
+    assert [p for _, p in metadata._by_time] == ["/a/1.jpg"]
@@ -0,0 +1,20 @@
+import metrics
+
+
+def _sample(text: str, name: str) -> str:
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return line.split(" ", 1)[1]
+    raise KeyError(name)
+
+
+def test_exposition_keeps_counter_precision():
+    metrics.counter("test_bytes_total").inc(123456789)
+    metrics.counter("test_bytes_total").inc(1)
+    metrics.gauge("test_temperature").set(45.123456789)
+    metrics.gauge("test_nan").set(float("nan"))
+    text = metrics.exposition()
+
+    assert _sample(text, "teleglobe_test_bytes_total") == "123456790"
+    assert float(_sample(text, "teleglobe_test_temperature")) == 45.123456789
+    assert _sample(text, "teleglobe_test_nan") == "NaN"
@@ -0,0 +1,80 @@
+import pytest
+
+import power
+
+
+@pytest.fixture
+def sleeping(monkeypatch):
+    """Globe in the sleep window with the recorded display actions"""
+    actions = []
+    config = {"wake_time": 0}
+    monkeypatch.setattr(power, "_config", lambda: config)
+    monkeypatch.setattr(power, "in_schedule", lambda now=None: True)
+    monkeypatch.setattr(power, "_temperature", None)
+    monkeypatch.setattr(power, "_throttled", 0)
+    monkeypatch.setattr(power, "_overheated", False)
+    monkeypatch.setattr(power, "_asleep", False)
+    monkeypatch.setattr(power, "_awake_until", 0.0)
+    monkeypatch.setattr(power, "_on_sleep", lambda: actions.append("sleep"))
+    monkeypatch.setattr(power, "_on_wake", lambda: actions.append("wake"))
+    power._update()
+    assert power.is_asleep()
+    return actions
+
+
+def test_awake_holds_the_display_during_playback(sleeping):
+    with power.awake():
+        assert not power.is_asleep()
+        # wake_time is over, but the requested media is still playing
+        power._update()
+        assert not power.is_asleep()
+    assert power.is_asleep()
+    assert sleeping == ["sleep", "wake", "sleep"]
+
+
+def test_nested_awake(sleeping):
+    with power.awake():
+        with power.awake():
+            pass
+        power._update()
+        assert not power.is_asleep()
+    assert power.is_asleep()
+
+
+def test_throttling_counts_as_heat(monkeypatch):
+    monkeypatch.setattr(power, "_config", lambda: {"warm_temp": 60, "max_temp": 75, "max_display_factor": 3})
+    monkeypatch.setattr(power, "_temperature", 50.0)
+    monkeypatch.setattr(power, "_throttled", 0x50000)
+    # Only the past throttling, the SoC is fine now
+    assert power.heat() == 0.0
+    assert power.display_time(10) == 10
+
+    monkeypatch.setattr(power, "_throttled", 0x50005)
+    assert power.heat() == 1.0
+    assert power.display_time(10) == 30
+
+
+def test_transitions_do_not_interleave(sleeping, monkeypatch):
+    import threading
+    import time
+
+    display = ["off"]
+    def display_off():
+        # The wake up request comes while the display is being turned off
+        time.sleep(0.2)
+        display[0] = "off"
+    def display_on():
+        display[0] = "on"
+    monkeypatch.setattr(power, "_on_sleep", display_off)
+    monkeypatch.setattr(power, "_on_wake", display_on)
+    monkeypatch.setattr(power, "_awake_until", time.monotonic() + 0.05)
+    monkeypatch.setattr(power, "_asleep", False)
+
+    time.sleep(0.1)
+    monitor = threading.Thread(target=power._update)
+    monitor.start()
+    time.sleep(0.05)
+    with power.awake():
+        monitor.join()
+        assert not power.is_asleep()
+        assert display[0] == "on"
@@ -0,0 +1,45 @@
+import time
+import threading
+
+import pytest
+
+import profiler
+
+
+@pytest.fixture
+def busy_thread():
+    stop = threading.Event()
+    thread = threading.Thread(target=lambda: stop.wait(10), name="busy thread")
+    thread.start()
+    yield thread
+    stop.set()
+    thread.join()
+
+
+@pytest.mark.parametrize("duration", [float("nan"), 0, -5])
+def test_invalid_duration_takes_one_sample(busy_thread, duration):
+    start = time.monotonic()
+    stacks, stats = profiler.sample(duration)
+    assert time.monotonic() - start < 1
+    assert "busy_thread;" in stacks
+    assert stats.startswith("samples: 1,")
+    # The lock is released for the next request
+    assert profiler.sample(0.01) is not None
+
+
+def test_infinite_duration_is_capped(monkeypatch, busy_thread):
+    monkeypatch.setattr(profiler, "MAX_DURATION", 0.2)
+    start = time.monotonic()
+    stacks, stats = profiler.sample(float("inf"))
+    assert time.monotonic() - start < 1
+    assert stacks
+
+
+def test_concurrent_sampling_is_refused(busy_thread):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(profiler.sample(0.5)))
+    thread.start()
+    time.sleep(0.1)
+    assert profiler.sample(0.1) is None
+    thread.join()
+    assert result[0] is not None
@@ -0,0 +1,50 @@
+import sys
+import types
+
+import pytest
+
+# Display and file watcher are not available off the device
+interface = sys.modules.setdefault("interface", types.ModuleType("interface"))
+interface.SUPPORTED_IMAGES = {"jpg"}
+interface.SUPPORTED_VIDEOS = {"mp4"}
+sys.modules.setdefault("fsnotify", types.ModuleType("fsnotify"))
+
+import settings
+import metadata
+
+# The album is scanned on import
+settings._settings.setdefault("slideshow", {"directories": []})
+import slideshow
+
+
+@pytest.fixture
+def on_this_day(monkeypatch):
+    monkeypatch.setitem(settings._settings, "slideshow", {"mode": "on_this_day"})
+    monkeypatch.setattr(slideshow, "_album_paths", {"/a/dup.jpg", "/a/other.jpg", "/a/third.jpg"})
+    monkeypatch.setattr(slideshow, "_current_album_paths", [])
+    # The only record of today is the duplicate
+    monkeypatch.setattr(metadata, "next_on_this_day", lambda path: "/a/dup.jpg")
+
+
+def test_skipped_path_falls_back_to_random(on_this_day):
+    assert slideshow.next_path(None) == "/a/dup.jpg"
+    # The random order goes through the whole album instead of the same path
+    picked = [slideshow.next_path("/a/dup.jpg", {"/a/dup.jpg"}) for _ in range(3)]
+    assert sorted(picked) == ["/a/dup.jpg", "/a/other.jpg", "/a/third.jpg"]
+
+
+def test_duplicate_of_the_day_does_not_spin(on_this_day, monkeypatch):
+    shown = []
+    def show_image(path, wait_sec=0, center=False):
+        shown.append(path)
+        if len(shown) == 2:
+            slideshow.stop()
+    monkeypatch.setattr(interface, "show_image", show_image, raising=False)
+    monkeypatch.setattr(slideshow.album, "is_duplicate", lambda path: path == "/a/dup.jpg")
+    monkeypatch.setattr(slideshow, "_slideshow_active", True)
+
+    thread = slideshow.threading.Thread(target=slideshow._background_slideshow)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert len(shown) == 2 and "/a/dup.jpg" not in shown
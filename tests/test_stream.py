@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import types
+import threading
+import functools
+import urllib.request
+
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+# Player and extractor are not available off the device
+sys.modules.setdefault("youtube_dl", types.ModuleType("youtube_dl"))
+sys.modules.setdefault("interface", types.ModuleType("interface"))
+
+import stream
+
+
+class Player:
+    """Reads the whole URL like omxplayer would"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.data = b""
+        self._thread = threading.Thread(target=self._read)
+        self._thread.start()
+
+    def _read(self) -> None:
+        with urllib.request.urlopen(self.url, timeout=10) as resp:
+            self.data = resp.read()
+
+    def wait(self) -> bytes:
+        self._thread.join(10)
+        return self.data
+
+
+@pytest.fixture
+def origin(tmp_path):
+    """Local stand-in for the video hosting"""
+    root = tmp_path / "origin"
+    root.mkdir()
+    content = os.urandom(3 * 1024 * 1024 + 123)
+    (root / "video.mp4").write_bytes(content)
+
+    requests = []
+    class Handler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+        def do_GET(self):
+            requests.append(self.path)
+            super().do_GET()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(Handler, directory=str(root)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield types.SimpleNamespace(
+        url="http://127.0.0.1:%d/video.mp4" % server.server_address[1],
+        content=content,
+        requests=requests,
+    )
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch, origin):
+    cache = tmp_path / "cache"
+    config = {"cache_directory": str(cache), "buffer_bytes": 256 * 1024}
+    monkeypatch.setattr(stream, "_config", lambda: config)
+    monkeypatch.setattr(stream, "_manifests", type(stream._manifests)())
+
+    extracted = []
+    class YoutubeDL:
+        def __init__(self, params):
+            pass
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            pass
+        def extract_info(self, url, download=False):
+            extracted.append(url)
+            return {"title": "Video", "formats": [
+                {"format_id": "hls", "url": origin.url, "protocol": "m3u8", "vcodec": "avc1", "width": 1920, "height": 1080},
+                {"format_id": "18", "url": origin.url, "ext": "mp4", "vcodec": "avc1.42001E", "acodec": "mp4a.40.2", "width": 640, "height": 360},
+            ]}
+
+    players = []
+    def show_video(url):
+        players.append(Player(url))
+        return players[-1]
+
+    monkeypatch.setattr(sys.modules["youtube_dl"], "YoutubeDL", YoutubeDL, raising=False)
+    monkeypatch.setattr(sys.modules["interface"], "screen_size", lambda: {"width": 480, "height": 480}, raising=False)
+    monkeypatch.setattr(sys.modules["interface"], "show_video", show_video, raising=False)
+    return types.SimpleNamespace(cache=cache, config=config, extracted=extracted, players=players)
+
+
+def _wait_cached(path, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while not os.path.isfile(path):
+        assert time.monotonic() < deadline, "download did not finish"
+        time.sleep(0.05)
+
+
+def test_choose_format():
+    formats = [
+        {"format_id": "webm", "url": "u", "vcodec": "vp9", "width": 640, "height": 360},
+        {"format_id": "dash", "url": "u", "protocol": "http_dash_segments", "vcodec": "avc1", "width": 640, "height": 360},
+        {"format_id": "audio", "url": "u", "vcodec": "none", "acodec": "mp4a"},
+        {"format_id": "small", "url": "u", "vcodec": "avc1", "acodec": "mp4a", "width": 426, "height": 240},
+        {"format_id": "medium", "url": "u", "vcodec": "avc1", "acodec": "mp4a", "width": 640, "height": 360},
+        {"format_id": "large", "url": "u", "vcodec": "avc1", "acodec": "mp4a", "width": 1280, "height": 720},
+        {"format_id": "unknown", "url": "u", "ext": "mp4"},
+    ]
+    choose = lambda screen: stream.choose_format(formats, screen)["format_id"]
+
+    assert choose({"width": 480, "height": 320}) == "medium"
+    assert choose({"width": 720, "height": 720}) == "large"
+    # Nothing covers the screen, the biggest one is used
+    assert choose({"width": 2160, "height": 2160}) == "large"
+    assert stream.choose_format(formats[:3], {"width": 480, "height": 480}) is None
+
+
+def test_cold_play_and_cache_replay(env, origin):
+    proc, media, ttff = stream.play("https://example.com/watch?v=1")
+    assert media["url"] == origin.url
+    assert media["width"] == 640
+    assert proc.url.startswith("http://127.0.0.1:")
+    assert 0 < ttff < 5
+    # The player gets the whole file while it is being downloaded
+    assert proc.wait() == origin.content
+
+    cached = os.path.join(str(env.cache), media["key"])
+    _wait_cached(cached)
+    assert open(cached, "rb").read() == origin.content
+    assert origin.requests == ["/video.mp4"]
+
+    proc, again, ttff = stream.play("https://example.com/watch?v=1")
+    assert again["key"] == media["key"]
+    assert 0 < ttff < 5
+    assert proc.wait() == origin.content
+    # Both the manifest and the media are reused
+    assert env.extracted == ["https://example.com/watch?v=1"]
+    assert origin.requests == ["/video.mp4"]
+
+
+def test_range_request(env, origin):
+    _, media, _ = stream.play("https://example.com/watch?v=2")
+    env.players[-1].wait()
+    _wait_cached(os.path.join(str(env.cache), media["key"]))
+
+    request = urllib.request.Request(stream._server_url(media["key"]), headers={"Range": "bytes=1000-"})
+    with urllib.request.urlopen(request, timeout=10) as resp:
+        assert resp.status == 206
+        assert resp.headers["Content-Range"] == "bytes 1000-%d/%d" % (len(origin.content) - 1, len(origin.content))
+        assert resp.read() == origin.content[1000:]
+
+
+def test_enforce_budget(env):
+    env.cache.mkdir()
+    now = time.time()
+    for i, name in enumerate(["keep", "old", "middle", "new", "partial.part"]):
+        path = env.cache / name
+        path.write_bytes(b"x" * 1000)
+        os.utime(path, (now - 100 + i, now - 100 + i))
+    # The playing one is kept even being the oldest
+    env.config["cache_bytes"] = 2500
+
+    stream._enforce_budget(str(env.cache / "keep"))
+
+    assert sorted(os.listdir(env.cache)) == ["keep", "new", "partial.part"]